@@ -0,0 +1,63 @@
+"""
+Sends a burst of chat messages into a room and counts the writes the
+server makes to deliver them, showing how queued packets are batched.
+
+Usage: python benchmarks/batched_send.py [--engine asyncio|thread] [-n 5000]
+"""
+import argparse, socket, threading, time
+import stubs
+import server
+from packet import *
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', choices=['asyncio', 'thread'], default='asyncio')
+    parser.add_argument('-n', '--messages', type=int, default=5000)
+    parser.add_argument('--receivers', type=int, default=10)
+    parser.add_argument('--port', type=int, default=50520)
+    args = parser.parse_args()
+
+    serverClass = server.AsyncServer if args.engine == 'asyncio' else server.Server
+    srv = stubs.headlessServer(('127.0.0.1', args.port), serverClass)
+    threading.Thread(target=srv.runServer, daemon=True).start()
+    time.sleep(0.5)
+
+    socks = []
+    for i in range(args.receivers + 1):
+        sock = socket.create_connection(('127.0.0.1', args.port))
+        sock.sendall(encodePackets([(OPCODES["OPCODE_HELLO"], f'user{i}'),
+                                    (OPCODES["OPCODE_JOIN_ROOM"], 'room1')]))
+        socks.append(sock)
+    time.sleep(0.5)
+    writesBefore = sum(client.writes for client in srv.clientList)
+
+    # Readers count the chat messages that reach them
+    received = [0] * len(socks)
+    def reader(index, sock):
+        decoder = FrameDecoder()
+        while received[index] < args.messages:
+            data = sock.recv(65536)
+            if not data:
+                return
+            received[index] += sum(1 for pkt in decoder.feed(data)
+                                   if pkt[0] == OPCODES["OPCODE_BROADCAST_MSG"])
+    readers = [threading.Thread(target=reader, args=(i, sock), daemon=True) for i, sock in enumerate(socks)]
+    for thread in readers:
+        thread.start()
+
+    start = time.perf_counter()
+    burst = encodePackets([(OPCODES["OPCODE_SEND_MSG"], f'message {i}') for i in range(args.messages)])
+    socks[0].sendall(burst)
+    for thread in readers:
+        thread.join(30)
+    elapsed = time.perf_counter() - start
+
+    delivered = sum(received)
+    writes = sum(client.writes for client in srv.clientList) - writesBefore
+    print(f'{args.engine}: {delivered} messages delivered to {len(socks)} clients in {elapsed:.2f}s')
+    print(f'{writes} writes, {delivered / max(writes, 1):.1f} messages per write')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Measures how chat throughput scales with the number of worker processes.
+
+Runs loadgen.py against a cluster of 1 to K workers with the same
+offered load, high enough to saturate one worker, and reports the
+messages delivered per second and server CPU for each size. Scaling
+needs at least K + procs free cores, on fewer cores the workers only
+share the same CPU.
+
+Usage: python benchmarks/cluster_scaling.py [--max-workers 4] [--clients 400]
+       [--rooms 40] [--rate 50] [--duration 5] [--procs 2] [--output scaling.json]
+"""
+import argparse, json, os, subprocess, sys, tempfile
+
+LOADGEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loadgen.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--engine', choices=['asyncio', 'thread'], default='asyncio')
+    parser.add_argument('--clients', type=int, default=400)
+    parser.add_argument('--rooms', type=int, default=40)
+    parser.add_argument('--rate', type=float, default=50, help='messages per second per client')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--procs', type=int, default=2, help='load generator processes')
+    parser.add_argument('--port', type=int, default=50630)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    runs = []
+    print(f'{"workers":>7}  {"delivered/s":>12}  {"speedup":>7}  {"server cpu %":>12}  {"p99 ms":>8}')
+    for workers in range(1, args.max_workers + 1):
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            # A new port each run, the last cluster's sockets may linger
+            subprocess.run([sys.executable, LOADGEN, '--workers', str(workers), '--engine', args.engine,
+                            '--clients', str(args.clients), '--rooms', str(args.rooms),
+                            '--rate', str(args.rate), '--duration', str(args.duration),
+                            '--procs', str(args.procs), '--port', str(args.port + workers),
+                            '--output', out.name], check=True, stdout=subprocess.DEVNULL)
+            result = json.load(open(out.name))
+        runs.append(result)
+        speedup = result['delivered_per_s'] / runs[0]['delivered_per_s']
+        print(f'{workers:>7}  {result["delivered_per_s"]:>12.1f}  {speedup:>7.2f}  '
+              f'{result["server_cpu_percent"]:>12.1f}  {result["latency_ms"]["p99"]:>8}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'cpus': os.cpu_count(), 'runs': runs}, f, indent=2)
+            f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
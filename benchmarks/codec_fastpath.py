@@ -0,0 +1,140 @@
+"""
+Compares the precompiled packet codec against the original
+implementation it replaced, checks both give identical bytes
+and reports the time per call.
+
+Usage: python benchmarks/codec_fastpath.py [-n 200000]
+"""
+import argparse, struct, timeit
+import stubs
+import packet
+from packet import *
+
+
+class Legacy:
+    """
+    The codec as it was before the fast path, kept for comparison
+    """
+
+    @staticmethod
+    def getOpCode(num):
+        for k,v in OPCODES.items():
+            if num == v:
+                return k
+        return "OPCODE_UNKNOWN"
+
+    @staticmethod
+    def getErrCode(num):
+        for k,v in ERRORCODES.items():
+            if num == v:
+                return k
+        return "ERR_UNKNOWN"
+
+    @staticmethod
+    def encodePacket(opCode, payload='0'):
+        if opCode not in OPCODES.values():
+            return 'ERROR ENCODING PACKET - Illegal OPCODE provided'
+        if type(payload) == str:
+            msg_bin = payload.encode()
+        else:
+            msg_bin = struct.pack(ERROR_FMT,payload)
+        msg_size = len(msg_bin)
+        if (msg_size + HEADER_SIZE) > MAX_PACKET_SIZE:
+            return 'ERROR ENCODING PACKET - Payload excees Max Packet Size'
+        header = struct.pack(HEADER_FMT, opCode, msg_size)
+        return struct.pack(f'{HEADER_SIZE}s{msg_size}s', header, msg_bin)
+
+    @staticmethod
+    def encodeError(code):
+        errCode = code
+        if code not in ERRORCODES.values():
+            errCode = ERRORCODES["ERR_UNKNOWN"]
+        header = struct.pack(HEADER_FMT, OPCODES["OPCODE_ERR"], ERROR_SIZE)
+        return struct.pack(f'{HEADER_SIZE}s{ERROR_FMT}', header, errCode)
+
+    @staticmethod
+    def decodePacket(packet):
+        header, bin_pyld = struct.unpack(f'{HEADER_SIZE}s{len(packet)-HEADER_SIZE}s',packet)
+        opCode, length = struct.unpack(HEADER_FMT, header)
+        if opCode not in OPCODES.values():
+            return Legacy.encodePacket(OPCODES["OPCODE_ERR"], ERRORCODES["ERR_ILLEGAL_OPCODE"])
+        if length != len(bin_pyld):
+            return Legacy.encodePacket(OPCODES["OPCODE_ERR"], ERRORCODES["ERR_ILLEGAL_LENGTH"])
+        if opCode == OPCODES["OPCODE_ERR"] and len(bin_pyld) == ERROR_SIZE:
+            return (opCode, length, struct.unpack(ERROR_FMT,bin_pyld)[0])
+        return (opCode, length, bin_pyld.decode())
+
+
+def checkIdentical():
+    """
+    Both codecs must produce the same bytes and decode to the same values
+    """
+    # Larger payloads are fragmented now instead of failing
+    payloads = ['', '0', 'hello', 'é' * 300, 'x' * (MAX_PACKET_SIZE - HEADER_SIZE), 4]
+    for opCode in list(OPCODES.values()) + [99]:
+        for payload in payloads:
+            old = Legacy.encodePacket(opCode, payload)
+            # Encoding errors are raised now instead of returned as text
+            if type(old) == str:
+                try:
+                    packet.encodePacket(opCode, payload)
+                except ValueError:
+                    continue
+                raise AssertionError((opCode, payload[:20]))
+            assert packet.encodePacket(opCode, payload) == old, (opCode, payload[:20])
+            if type(old) == bytes:
+                assert packet.decodePacket(old) == Legacy.decodePacket(old), (opCode, payload[:20])
+                assert packet.decodePacket(memoryview(old)) == Legacy.decodePacket(old), (opCode, payload[:20])
+    for code in list(ERRORCODES.values()) + [3, 77]:
+        assert packet.encodeError(code) == Legacy.encodeError(code), code
+    bad = struct.pack(HEADER_FMT, 99, 0)
+    assert packet.decodePacket(bad) == Legacy.decodePacket(bad)
+    short = struct.pack(HEADER_FMT, 8, 10) + b'abc'
+    assert packet.decodePacket(short) == Legacy.decodePacket(short)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=200000)
+    args = parser.parse_args()
+
+    checkIdentical()
+    print('output is byte-identical\n')
+
+    msg = encodePacket(OPCODES["OPCODE_SEND_MSG"], 'x' * 200)
+    stream = msg * 2
+    buffer = bytearray(MAX_PACKET_SIZE)
+    cases = [
+        ('encodePacket 200B', lambda c: c.encodePacket(OPCODES["OPCODE_SEND_MSG"], 'x' * 200)),
+        ('encodeError', lambda c: c.encodeError(ERRORCODES["ERR_NOT_IN_ROOM"])),
+        ('decodePacket 200B', lambda c: c.decodePacket(msg)),
+        ('getOpCode', lambda c: c.getOpCode(OPCODES["OPCODE_BROADCAST_MSG"])),
+        ('getErrCode', lambda c: c.getErrCode(ERRORCODES["ERR_NOT_IN_ROOM"])),
+    ]
+    print(f'{"case":<22}{"legacy ns":>12}{"fast ns":>12}{"speedup":>10}')
+    for name, fn in cases:
+        old = min(timeit.repeat(lambda: fn(Legacy), number=args.number, repeat=3)) / args.number * 1e9
+        new = min(timeit.repeat(lambda: fn(packet), number=args.number, repeat=3)) / args.number * 1e9
+        print(f'{name:<22}{old:>12.0f}{new:>12.0f}{old / new:>9.2f}x')
+
+    # Paths that avoid a copy, each against the plain bytes
+    # path it stands in for. A speedup below 1 is a loss
+    view = memoryview(stream)[:len(msg)]
+    batch = [(OPCODES["OPCODE_BROADCAST_MSG"], 'x' * 200)] * 10
+    def copyInto():
+        packet = encodePacket(OPCODES["OPCODE_SEND_MSG"], 'x' * 200)
+        buffer[:len(packet)] = packet
+    pairs = [
+        ('decodePacket view', lambda: decodePacket(msg), lambda: decodePacket(view)),
+        ('encodePacketInto', copyInto, lambda: encodePacketInto(buffer, 0, OPCODES["OPCODE_SEND_MSG"], 'x' * 200)),
+        ('encodePackets 10', lambda: b''.join([encodePacket(opCode, payload) for opCode, payload in batch]),
+         lambda: encodePackets(batch)),
+    ]
+    print(f'\n{"case":<22}{"bytes ns":>12}{"path ns":>12}{"speedup":>10}')
+    for name, plain, path in pairs:
+        old = min(timeit.repeat(plain, number=args.number, repeat=3)) / args.number * 1e9
+        new = min(timeit.repeat(path, number=args.number, repeat=3)) / args.number * 1e9
+        print(f'{name:<22}{old:>12.0f}{new:>12.0f}{old / new:>9.2f}x')
+
+if __name__ == '__main__':
+    main()
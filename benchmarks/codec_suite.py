@@ -0,0 +1,225 @@
+"""
+Microbenchmark suite for the packet codec with a regression gate.
+
+Times encodePacket, decodePacket, encodeError, decodePayload and the
+opcode and error lookups over payloads from empty up to
+MAX_PACKET_SIZE, including error frames. Each case is compared
+against a stored baseline and the script exits with status 1 when
+any case is slower than the baseline by more than the tolerance.
+
+Every case is timed in turns with a fixed reference workload and
+reported as the median of its per round times relative to the
+reference, scaled to the baseline's reference time, so a machine that
+is busier or slower as a whole does not show up as a slower codec.
+
+The default tolerance of 15% needs a quiet machine. Each run reports
+how far a small case moves between passes and warns when that is above
+the tolerance: on shared or single core hosts it can reach 30%, and
+there only a looser --tolerance such as 0.5 passes reliably, which
+catches gross regressions only.
+
+Baselines are only meaningful on the machine that recorded them,
+record a new one with --update after moving to other hardware.
+
+Usage: python benchmarks/codec_suite.py [--baseline codec_baseline.json]
+       [--tolerance 0.15] [--retries 3] [--update] [--filter decodePacket]
+"""
+import argparse, json, os, platform, statistics, sys, timeit
+import stubs
+from packet import *
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codec_baseline.json')
+
+"""
+Payload sizes in bytes, the largest fills a whole packet
+"""
+SIZES = (0, 1, 16, 128, 512, MAX_PAYLOAD_SIZE // 2, MAX_PAYLOAD_SIZE)
+
+
+def buildCases():
+    """
+    Returns an ordered dict of case name -> zero argument callable
+    """
+    cases = {}
+    send = OPCODES["OPCODE_SEND_MSG"]
+    err = OPCODES["OPCODE_ERR"]
+
+    for size in SIZES:
+        text = 'x' * size
+        frame = encodePacket(send, text)
+        view = memoryview(frame)
+        body = frame[HEADER_SIZE:]
+        cases[f'encodePacket/{size}'] = lambda text=text: encodePacket(send, text)
+        cases[f'decodePacket/bytes/{size}'] = lambda frame=frame: decodePacket(frame)
+        cases[f'decodePacket/memoryview/{size}'] = lambda view=view: decodePacket(view)
+        cases[f'decodePayload/{size}'] = lambda body=body: decodePayload(send, body)
+
+    # Error frames
+    errFrame = encodeError(ERRORCODES["ERR_NAME_EXISTS"])
+    errBody = errFrame[HEADER_SIZE:]
+    badOpcode = encodeHeader(0xFF, 1) + b'0'
+    badLength = encodeHeader(send, 5) + b'0'
+    cases['encodePacket/error'] = lambda: encodePacket(err, ERRORCODES["ERR_NAME_EXISTS"])
+    cases['encodeError/known'] = lambda: encodeError(ERRORCODES["ERR_NAME_EXISTS"])
+    cases['encodeError/unknown'] = lambda: encodeError(9999)
+    cases['decodePacket/error'] = lambda: decodePacket(errFrame)
+    cases['decodePacket/illegal_opcode'] = lambda: decodePacket(badOpcode)
+    cases['decodePacket/illegal_length'] = lambda: decodePacket(badLength)
+    cases['decodePayload/error'] = lambda: decodePayload(err, errBody)
+
+    # Lookups
+    cases['getOpCode/known'] = lambda: getOpCode(send)
+    cases['getOpCode/unknown'] = lambda: getOpCode(0xFF)
+    cases['getErrCode/known'] = lambda: getErrCode(ERRORCODES["ERR_NAME_EXISTS"])
+    cases['getErrCode/unknown'] = lambda: getErrCode(9999)
+    return cases
+
+
+def reference():
+    """
+    Fixed interpreter work unrelated to the codec, timed with the
+    cases so a slower machine is not mistaken for a slower codec
+    """
+    total = 0
+    for i in range(64):
+        total += i * i
+    return str(total).encode()
+
+
+def calibrate(timer, minTime):
+    """
+    Calls per timed run, raised until one run takes at least minTime seconds
+    """
+    number = 1
+    while timer.timeit(number) < minTime:
+        number *= 2
+    return number
+
+
+def timeCase(func, repeat, minTime):
+    """
+    Median time per call in nanoseconds over repeat runs
+    """
+    timer = timeit.Timer(func)
+    number = calibrate(timer, minTime)
+    return statistics.median(timer.repeat(repeat, number)) / number * 1e9
+
+
+def timeRelative(func, repeat, minTime):
+    """
+    Time of func divided by the time of the reference. The two are
+    timed in turns, repeat rounds of one run each, and the median of
+    the per round ratios is kept so a burst of other work that slows
+    one round does not move the result
+    """
+    timer = timeit.Timer(func)
+    refTimer = timeit.Timer(reference)
+    number = calibrate(timer, minTime)
+    refNumber = calibrate(refTimer, minTime)
+    ratios = []
+    for _ in range(repeat):
+        refTime = refTimer.timeit(refNumber) / refNumber
+        ratios.append(timer.timeit(number) / number / refTime)
+    return statistics.median(ratios)
+
+
+def noise(repeat, minTime, passes=5):
+    """
+    Spread over several passes of a small case, the noisiest kind,
+    as a fraction. A change smaller than this cannot be told apart
+    from noise
+    """
+    probe = lambda: encodePacket(OPCODES["OPCODE_SEND_MSG"], 'x')
+    ratios = [timeRelative(probe, repeat, minTime) for _ in range(passes)]
+    return max(ratios) / min(ratios) - 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed slowdown as a fraction of the baseline')
+    parser.add_argument('--repeat', type=int, default=15,
+                        help='rounds each case is timed in, the median round is kept')
+    parser.add_argument('--min-time', type=float, default=0.01,
+                        help='seconds each timed run should last')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='times a slow case is timed again before it counts as a regression')
+    parser.add_argument('--filter', default='', help='only run cases containing this text')
+    parser.add_argument('--update', action='store_true', help='record the results as the new baseline')
+    args = parser.parse_args()
+
+    cases = {name: func for name, func in buildCases().items() if args.filter in name}
+
+    baseline = {}
+    if not args.update and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored['cases']
+        refNs = stored['reference']
+    else:
+        refNs = timeCase(reference, args.repeat, args.min_time)
+
+    # Times are kept relative to the reference and shown in
+    # nanoseconds of a machine whose reference takes refNs
+    results = {name: timeRelative(func, args.repeat, args.min_time) * refNs for name, func in cases.items()}
+
+    # A new baseline keeps the median of several passes, the
+    # fastest would leave the gate tighter than the noise allows
+    if args.update:
+        passes = {name: [ns] for name, ns in results.items()}
+        for _ in range(args.retries):
+            for name, func in cases.items():
+                passes[name].append(timeRelative(func, args.repeat, args.min_time) * refNs)
+        results = {name: statistics.median(times) for name, times in passes.items()}
+
+    regressions = []
+    width = max(map(len, results))
+    print(f'{"case":<{width}}  {"ns/call":>10}  {"baseline":>10}  {"change":>8}')
+    for name, ns in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f'{name:<{width}}  {ns:>10.1f}  {"-":>10}  {"-":>8}')
+            continue
+        # A burst of other work can still slow one case, time it
+        # again and keep the fastest
+        for _ in range(args.retries):
+            if ns / base - 1 <= args.tolerance:
+                break
+            retry = timeRelative(cases[name], args.repeat, args.min_time) * refNs
+            ns = results[name] = min(ns, retry)
+        change = ns / base - 1
+        flag = ''
+        if change > args.tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<{width}}  {ns:>10.1f}  {base:>10.1f}  {change:>+8.1%}{flag}')
+
+    # How far results on this machine move with no change at all
+    spread = noise(args.repeat, args.min_time)
+    print(f'\nNoise: a small case moves by {spread:.0%} between passes')
+    if spread > args.tolerance:
+        print(f'The noise is above the {args.tolerance:.0%} tolerance, '
+              f'expect cases to fail at random on this machine')
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'reference': round(refNs, 1),
+                'cases': {name: round(ns, 1) for name, ns in results.items()},
+            }, f, indent=2)
+            f.write('\n')
+        print(f'\nBaseline written to {args.baseline}')
+    elif not baseline:
+        print(f'\nNo baseline at {args.baseline}, run with --update to record one')
+    elif regressions:
+        print(f'\n{len(regressions)} case(s) slower than the baseline by more than {args.tolerance:.0%}')
+        sys.exit(1)
+    else:
+        print(f'\nAll cases within {args.tolerance:.0%} of the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Reports the bytes saved and the CPU spent by payload compression
+for typical chat traffic, room lists and user lists.
+
+Usage: python benchmarks/compression.py [-n 2000]
+"""
+import argparse, random, time
+import stubs
+import packet
+from packet import *
+
+WORDS = ('the and you that was for are with his they this have from one had word but not what all were '
+         'when your can said there use each which she how their will other about out many then them these '
+         'lol ok yes hey hi hello thanks room server chat today tomorrow meeting build deploy test').split()
+
+
+def samples(rng, count):
+    """
+    Payload sets resembling real traffic
+    """
+    chat = ['<user%d> %s' % (rng.randint(0, 999), ' '.join(rng.choice(WORDS) for i in range(rng.randint(3, 60))))
+            for i in range(count)]
+    rooms = [','.join(f'room{n}' for n in range(rng.randint(50, 500))) for i in range(count // 20)]
+    users = [','.join(f'guest({n})' for n in range(rng.randint(50, 500))) for i in range(count // 20)]
+    return {'chat': chat, 'room lists': rooms, 'user lists': users}
+
+
+def measure(payloads, threshold, useDict):
+    packet.COMPRESS_THRESHOLD = threshold
+    zdict = packet.COMPRESS_DICT
+    if not useDict:
+        packet.COMPRESS_DICT = b'\0'
+    try:
+        raw = sum(len(encodePacket(OPCODES["OPCODE_BROADCAST_MSG"], p)) for p in payloads)
+        start = time.perf_counter()
+        encoded = [encodePacket(OPCODES["OPCODE_BROADCAST_MSG"], p, COMPRESS_ZLIB) for p in payloads]
+        encodeTime = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in encoded:
+            for decoded in FrameDecoder().feed(data):
+                pass
+        decodeTime = time.perf_counter() - start
+    finally:
+        packet.COMPRESS_DICT = zdict
+    sent = sum(len(data) for data in encoded)
+    return raw, sent, encodeTime / len(payloads) * 1e6, decodeTime / len(payloads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--messages', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    threshold = COMPRESS_THRESHOLD
+    print(f'{"payloads":<12}{"threshold":>10}{"dict":>6}{"raw B":>10}{"sent B":>10}{"saved":>8}'
+          f'{"enc us":>9}{"dec us":>9}')
+    for name, payloads in samples(random.Random(args.seed), args.messages).items():
+        for limit in (0, threshold, 512):
+            for useDict in (True, False):
+                raw, sent, enc, dec = measure(payloads, limit, useDict)
+                print(f'{name:<12}{limit:>10}{"yes" if useDict else "no":>6}{raw:>10}{sent:>10}'
+                      f'{1 - sent / raw:>8.0%}{enc:>9.1f}{dec:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Pipelines thousands of packets through FrameDecoder, cut into reads
+of random size the way TCP may deliver them, and reports the rate.
+
+Usage: python benchmarks/frame_decoder.py [-n 100000] [--max-read 4096]
+"""
+import argparse, random, time
+import stubs
+from packet import *
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--frames', type=int, default=100000)
+    parser.add_argument('--max-read', type=int, default=4096)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    frames = [encodePacket(OPCODES["OPCODE_SEND_MSG"], 'x' * rng.randint(0, 200))
+              for i in range(args.frames)]
+    stream = b''.join(frames)
+
+    # Split the stream at random points
+    reads = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.randint(1, args.max_read)
+        reads.append(stream[pos:pos + size])
+        pos += size
+
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    decoded = 0
+    for data in reads:
+        for decodedPkt in decoder.feed(data):
+            decoded += 1
+    elapsed = time.perf_counter() - start
+
+    assert decoded == args.frames and not decoder.buffer, 'stream was not fully decoded'
+    print(f'{decoded} frames in {len(reads)} reads ({len(stream)} bytes)')
+    print(f'{elapsed:.3f}s - {decoded / elapsed:,.0f} frames/s, {len(stream) / elapsed / 1e6:.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
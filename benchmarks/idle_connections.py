@@ -0,0 +1,60 @@
+"""
+Opens many idle connections against a headless server and reports
+how much memory the server spends on each one.
+
+Usage: python benchmarks/idle_connections.py [--engine asyncio|thread] [-n 10000]
+"""
+import argparse, json, multiprocessing, socket, time
+import stubs
+
+
+def runServer(port, engine, ready):
+    import server
+    serverClass = server.AsyncServer if engine == 'asyncio' else server.Server
+    srv = stubs.headlessServer(('127.0.0.1', port), serverClass)
+    ready.set()
+    srv.runServer()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', choices=['asyncio', 'thread'], default='asyncio')
+    parser.add_argument('-n', '--connections', type=int, default=10000)
+    parser.add_argument('--port', type=int, default=50500)
+    args = parser.parse_args()
+
+    ready = multiprocessing.Event()
+    proc = multiprocessing.Process(target=runServer, args=(args.port, args.engine, ready), daemon=True)
+    proc.start()
+    ready.wait()
+    time.sleep(0.5)
+    baseRss = stubs.rssKb(proc.pid)
+
+    # Connect and read the HELLO so every connection is fully accepted
+    socks = []
+    start = time.perf_counter()
+    for i in range(args.connections):
+        sock = socket.create_connection(('127.0.0.1', args.port))
+        sock.recv(2048)
+        socks.append(sock)
+    elapsed = time.perf_counter() - start
+    time.sleep(1)
+    finalRss = stubs.rssKb(proc.pid)
+
+    result = {
+        'engine': args.engine,
+        'connections': len(socks),
+        'connect_seconds': round(elapsed, 3),
+        'server_rss_kb_before': baseRss,
+        'server_rss_kb_after': finalRss,
+        'bytes_per_connection': round((finalRss - baseRss) * 1024 / len(socks)),
+    }
+    print(json.dumps(result, indent=2))
+
+    for sock in socks:
+        sock.close()
+    proc.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Loopback load generator for the chat server.
+
+Starts a headless server on 127.0.0.1 in its own process, or a cluster
+of K worker processes, connects N simulated clients that speak the
+packet.py protocol, spreads them over M rooms and has them send chat
+messages at a fixed rate. Reports throughput, broadcast fan-out
+latency, server CPU and RSS as JSON.
+
+The clients can be split over several processes so the load generator
+is not the bottleneck when the server has more than one core.
+
+Usage: python benchmarks/loadgen.py [--engine asyncio|thread] [--clients 200]
+       [--rooms 20] [--rate 2] [--duration 10] [--workers 0] [--procs 1]
+       [--output results.json]
+"""
+import argparse, json, multiprocessing, os, platform, selectors, socket, time
+import stubs
+from packet import *
+
+
+def runServer(port, engine, ready):
+    import server
+    serverClass = server.AsyncServer if engine == 'asyncio' else server.Server
+    srv = stubs.headlessServer(('127.0.0.1', port), serverClass)
+    ready.set()
+    srv.runServer()
+
+
+def cpuSeconds(pid):
+    """
+    User plus system CPU time of a process, read from /proc
+    """
+    with open(f'/proc/{pid}/stat') as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class SimClient:
+    """
+    One simulated user on a non-blocking socket
+    """
+
+    def __init__(self, name, port):
+        self.name = name
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setblocking(False)
+        self.decoder = FrameDecoder()
+        self.outgoing = bytearray()
+        self.room = None
+        self.wantRoom = None
+
+    def queue(self, messages):
+        self.outgoing += encodePackets(messages)
+
+    def flush(self):
+        if self.outgoing:
+            try:
+                sent = self.sock.send(self.outgoing)
+            except BlockingIOError:
+                return
+            del self.outgoing[:sent]
+
+
+class LoadGenerator:
+    """
+    One process worth of simulated clients, index tells the
+    processes apart so their user and room names differ
+    """
+
+    def __init__(self, args, index=0):
+        self.args = args
+        self.index = index
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.latencies = []
+        self.sent = 0
+        self.delivered = 0
+        self.measuring = False
+
+    def connect(self):
+        args = self.args
+        for i in range(args.clients // args.procs):
+            client = SimClient(f'load{self.index}-{i}', args.port)
+            self.selector.register(client.sock, selectors.EVENT_READ, client)
+            client.queue([(OPCODES["OPCODE_HELLO"], client.name)])
+            self.clients.append(client)
+
+        # The first client of each room creates it, the rest join
+        # once it exists
+        rooms = [f'bench{self.index}-{i}' for i in range(args.rooms // args.procs)]
+        for i, client in enumerate(self.clients[:len(rooms)]):
+            client.queue([(OPCODES["OPCODE_CREATE_ROOM"], rooms[i])])
+        self.pump(lambda: all(c.room for c in self.clients[:len(rooms)]))
+        for i, client in enumerate(self.clients[len(rooms):], len(rooms)):
+            client.wantRoom = rooms[i % len(rooms)]
+            client.queue([(OPCODES["OPCODE_JOIN_ROOM"], client.wantRoom)])
+        self.pump(lambda: all(c.room for c in self.clients))
+
+    def pump(self, done, timeout=60):
+        """
+        Run the client loop until done() is true
+        """
+        deadline = time.monotonic() + timeout
+        while not done():
+            if time.monotonic() > deadline:
+                raise SystemExit('timed out waiting for the server')
+            self.poll(0.01)
+
+    def poll(self, timeout):
+        for client in self.clients:
+            client.flush()
+        for key, events in self.selector.select(timeout):
+            client = key.data
+            try:
+                data = client.sock.recv(65536)
+            except BlockingIOError:
+                continue
+            if not data:
+                raise SystemExit('server closed a connection')
+            now = time.perf_counter_ns()
+            for decodedPkt in client.decoder.feed(data):
+                if type(decodedPkt) == bytes:
+                    continue
+                opCode, length, payload = decodedPkt
+                if opCode == OPCODES["OPCODE_JOIN_ROOM"]:
+                    client.room = payload
+                elif opCode == OPCODES["OPCODE_ERR"] and client.wantRoom and not client.room:
+                    # A room made on another worker may not have reached
+                    # this client's worker yet, ask again
+                    client.queue([(OPCODES["OPCODE_JOIN_ROOM"], client.wantRoom)])
+                elif opCode == OPCODES["OPCODE_PING"]:
+                    # Quiet clients are pinged, answer so they are not closed
+                    client.queue([(OPCODES["OPCODE_PONG"], payload)])
+                elif opCode == OPCODES["OPCODE_BROADCAST_MSG"] and self.measuring:
+                    # "<name> SENT_NS padding"
+                    sentNs = int(payload.split(' ', 2)[1])
+                    self.latencies.append(now - sentNs)
+                    self.delivered += 1
+
+    def run(self):
+        """
+        Send at the configured rate for the configured duration,
+        then let the last messages arrive. Returns the seconds
+        spent sending
+        """
+        args = self.args
+        interval = 1 / (args.rate * len(self.clients))
+        padding = 'x' * args.size
+        self.measuring = True
+        start = time.perf_counter()
+        end = start + args.duration
+        nextSend = start
+        turn = 0
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            while nextSend <= now:
+                client = self.clients[turn % len(self.clients)]
+                client.queue([(OPCODES["OPCODE_SEND_MSG"], f'{time.perf_counter_ns()} {padding}')])
+                self.sent += 1
+                turn += 1
+                nextSend += interval
+            self.poll(max(0, min(nextSend - time.perf_counter(), 0.01)))
+        elapsed = time.perf_counter() - start
+
+        # Drain what is still in flight
+        drainEnd = time.perf_counter() + args.drain
+        while time.perf_counter() < drainEnd:
+            self.poll(0.01)
+        return elapsed
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def runClients(args, index, barrier, results):
+    """
+    Run one process of clients. The barrier is passed once every
+    process is connected and again when the server's CPU time
+    has been read, then the clients start sending
+    """
+    load = LoadGenerator(args, index)
+    load.connect()
+    barrier.wait()
+    barrier.wait()
+    cpuStart = time.process_time()
+    elapsed = load.run()
+    results.put((load.sent, load.delivered, load.latencies, elapsed, time.process_time() - cpuStart))
+
+
+def startServers(args):
+    """
+    Start the server, or the cluster when workers are asked for.
+    Returns the server processes
+    """
+    if args.workers:
+        import cluster
+        return cluster.startCluster(('127.0.0.1', args.port), args.workers, args.engine == 'asyncio', quiet=True)
+
+    ready = multiprocessing.Event()
+    proc = multiprocessing.Process(target=runServer, args=(args.port, args.engine, ready), daemon=True)
+    proc.start()
+    if not ready.wait(10) or not proc.is_alive():
+        raise SystemExit('server failed to start')
+    return [proc]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--engine', choices=['asyncio', 'thread'], default='asyncio')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=2, help='messages per second per client')
+    parser.add_argument('--size', type=int, default=64, help='bytes of padding per message')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=2, help='seconds to wait for late messages')
+    parser.add_argument('--workers', type=int, default=0, help='run a cluster of this many server processes')
+    parser.add_argument('--procs', type=int, default=1, help='processes the clients are split over')
+    parser.add_argument('--port', type=int, default=50530)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+    if args.rooms < args.procs:
+        parser.error('--rooms must be at least --procs')
+
+    servers = startServers(args)
+    time.sleep(0.5)
+
+    barrier = multiprocessing.Barrier(args.procs + 1)
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=runClients, args=(args, i, barrier, results), daemon=True)
+               for i in range(args.procs)]
+    for proc in clients:
+        proc.start()
+    barrier.wait(120)
+    cpuStart = sum(cpuSeconds(proc.pid) for proc in servers)
+    barrier.wait()
+
+    sent = delivered = 0
+    latencies = []
+    elapsed = loadCpu = 0
+    for proc in clients:
+        procSent, procDelivered, procLatencies, procElapsed, procCpu = results.get()
+        sent += procSent
+        delivered += procDelivered
+        latencies += procLatencies
+        elapsed = max(elapsed, procElapsed)
+        loadCpu += procCpu
+    wall = elapsed + args.drain
+    serverCpu = sum(cpuSeconds(proc.pid) for proc in servers) - cpuStart
+    rss = sum(stubs.rssKb(proc.pid) for proc in servers)
+    for proc in servers + clients:
+        proc.terminate()
+
+    latencies.sort()
+    members = args.clients / args.rooms
+    ms = lambda ns: None if ns is None else round(ns / 1e6, 3)
+    result = {
+        'engine': args.engine,
+        'workers': args.workers,
+        'client_procs': args.procs,
+        'clients': args.clients,
+        'rooms': args.rooms,
+        'rate_per_client': args.rate,
+        'payload_bytes': args.size,
+        'duration_s': round(elapsed, 3),
+        'messages_sent': sent,
+        'messages_delivered': delivered,
+        'expected_deliveries': round(sent * members),
+        'delivered_per_s': round(delivered / elapsed, 1),
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 0.50)),
+            'p99': ms(percentile(latencies, 0.99)),
+            'p999': ms(percentile(latencies, 0.999)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'server_cpu_s': round(serverCpu, 3),
+        'server_cpu_percent': round(serverCpu / wall * 100, 1),
+        'server_rss_kb': rss,
+        'loadgen_cpu_s': round(loadCpu, 3),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Times broadcast and sendUsers for a server holding many users spread
+over many rooms. With the room membership index the cost follows the
+size of the room, not the number of users on the server.
+
+Usage: python benchmarks/room_index.py [--users 10000] [--rooms 1000]
+"""
+import argparse, time
+import stubs
+import server
+from packet import *
+from session import Session
+
+
+class FakeClient:
+    """
+    Stands in for a client socket, counts the bytes sent to it
+    """
+    def __init__(self, port):
+        self.peer = ('127.0.0.1', port)
+        self.sent = 0
+        self.compress = None
+        self.session = Session(self.peer)
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def getpeername(self):
+        return self.peer
+
+    def close(self):
+        pass
+
+
+def populate(srv, users, rooms):
+    for i in range(rooms):
+        room = f'bench{i}'
+        srv.roomList.append(room)
+        srv.roomMembers[room] = {}
+        srv.history[room] = server.RoomHistory(room)
+    clients = []
+    for i in range(users):
+        client = FakeClient(10000 + i)
+        srv.clientList.append(client)
+        client.session.rename(f'user{i}')
+        srv.joinMember(client, f'bench{i % rooms}')
+        clients.append(client)
+    return clients
+
+
+def timeCalls(fn, clients, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(clients[i % len(clients)])
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20000)
+    parser.add_argument('--port', type=int, default=50510)
+    args = parser.parse_args()
+
+    srv = stubs.headlessServer(('127.0.0.1', args.port))
+    clients = populate(srv, args.users, args.rooms)
+
+    broadcastUs = timeCalls(lambda c: srv.broadcast(c, 'hello'), clients, args.repeat)
+    usersUs = timeCalls(lambda c: srv.sendUsers(c, c.session.room), clients, args.repeat)
+    print(f'{args.users} users in {args.rooms} rooms ({args.users // args.rooms} per room)')
+    print(f'broadcast  {broadcastUs:8.2f} us/call')
+    print(f'sendUsers  {usersUs:8.2f} us/call')
+    srv.server.close()
+
+
+if __name__ == '__main__':
+    main()
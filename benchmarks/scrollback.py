@@ -0,0 +1,57 @@
+"""
+Measures how long inserting a batch of log lines takes as a log widget
+fills up, with and without the scrollback limit. Needs a display.
+
+Usage: python benchmarks/scrollback.py [-n 1000000] [--scrollback 10000]
+"""
+import argparse, time
+import stubs
+import tkinter as tk
+from tkinter import scrolledtext
+import gui
+
+
+def run(root, events, scrollback, batch):
+    """
+    Feed events lines through Gui.writeLines and return the
+    insert latency of a batch at regular points
+    """
+    window = object.__new__(gui.Gui)
+    window.scrollback = scrollback
+    window.history = None
+    textBox = scrolledtext.ScrolledText(root, width=100)
+    textBox.pack()
+    window.logWidget(textBox)
+
+    samples = []
+    line = '12:00:00 - <127.0.0.1:50000 - user> sent a message in "room1"\n'
+    for done in range(0, events, batch):
+        start = time.perf_counter()
+        window.writeLines({textBox: [line, 'normal'] * batch})
+        root.update_idletasks()
+        elapsed = time.perf_counter() - start
+        if (done // batch) % (events // batch // 10) == 0:
+            samples.append((done + batch, elapsed * 1e3))
+    textBox.destroy()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--events', type=int, default=1000000)
+    parser.add_argument('--scrollback', type=int, default=gui.SCROLLBACK_LINES)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    root = tk.Tk()
+    capped = run(root, args.events, args.scrollback, args.batch)
+    uncapped = run(root, args.events, 0, args.batch)
+    root.destroy()
+
+    print(f'{"events":>10}{"capped ms":>12}{"uncapped ms":>14}')
+    for (events, cappedMs), (_, uncappedMs) in zip(capped, uncapped):
+        print(f'{events:>10}{cappedMs:>12.2f}{uncappedMs:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Measures the memory kept for each connected user, a Session record
+against the three dicts that held the same state before (usernames
+by address, rooms and last packets by socket), and the time taken
+to build an event tag with each.
+
+Usage: python benchmarks/sessions.py [--sessions 100000]
+"""
+import argparse, time, tracemalloc
+import stubs
+from session import Session
+
+
+class Socket:
+    """
+    Stands in for a client socket as a dict key
+    """
+    __slots__ = ('peer',)
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def getpeername(self):
+        return self.peer
+
+
+def buildSessions(peers):
+    sessions = []
+    for i, peer in enumerate(peers):
+        session = Session(peer)
+        session.rename(f'user{i}')
+        session.room = 'room1'
+        session.lastPacket = b''
+        sessions.append(session)
+    return sessions
+
+
+def buildDicts(peers):
+    sockets = [Socket(peer) for peer in peers]
+    usernames, userRoom, lastPacket = {}, {}, {}
+    for i, sock in enumerate(sockets):
+        usernames[sock.peer] = f'user{i}'
+        userRoom[sock] = 'room1'
+        lastPacket[sock] = b''
+    return sockets, usernames, userRoom, lastPacket
+
+
+def measure(build, peers):
+    """
+    Bytes allocated by build(peers) that are still held when it returns
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(peers)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return kept, after - before
+
+
+def dictTag(sock, usernames):
+    """
+    Server.buildTag before sessions
+    """
+    clientIp = sock.getpeername()
+    tag = "<" + clientIp[0] + ":" + str(clientIp[1])
+    if clientIp in usernames:
+        tag += " - " + usernames[clientIp] + ">"
+    else:
+        tag += ">"
+    return tag
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sessions', type=int, default=100000)
+    args = parser.parse_args()
+
+    count = args.sessions
+    peers = [('127.0.0.1', 10000 + i % 50000) for i in range(count)]
+
+    sessions, sessionBytes = measure(buildSessions, peers)
+    (sockets, usernames, userRoom, lastPacket), dictBytes = measure(buildDicts, peers)
+    # Sockets stand in for the connection both layouts already have
+    socketBytes = measure(lambda peers: [Socket(peer) for peer in peers], peers)[1]
+
+    print(f'{count} users')
+    print(f'session  {sessionBytes / count:8.1f} bytes/user')
+    print(f'dicts    {(dictBytes - socketBytes) / count:8.1f} bytes/user')
+
+    start = time.perf_counter()
+    for session in sessions:
+        session.tag
+    sessionUs = (time.perf_counter() - start) / count * 1e6
+    start = time.perf_counter()
+    for sock in sockets:
+        dictTag(sock, usernames)
+    dictUs = (time.perf_counter() - start) / count * 1e6
+    print(f'tag      {sessionUs:8.3f} us session  {dictUs:8.3f} us dicts')
+
+
+if __name__ == '__main__':
+    main()
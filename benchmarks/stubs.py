@@ -0,0 +1,41 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Lets a Server run headless by standing in for the Tk widgets
+it normally writes to.
+"""
+import os, sys
+
+# Benchmarks live one level below the project modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class NullText:
+    """
+    Accepts every call a ScrolledText would and does nothing
+    """
+    def __getattr__(self, name):
+        return self._ignore
+
+    def _ignore(self, *args, **kwargs):
+        return ''
+
+
+def headlessServer(netInfo, serverClass=None):
+    """
+    Build a Server with stub widgets bound to netInfo
+    """
+    import server
+    serverClass = serverClass or server.Server
+    return serverClass(netInfo, NullText(), NullText(), NullText())
+
+
+def rssKb(pid='self'):
+    """
+    Resident set size of a process in KB, read from /proc
+    """
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
@@ -0,0 +1,74 @@
+"""
+Times a burst of logins that all ask for the same username. The old
+scan over every username for each "(i)" tried is run on fewer logins,
+each login costs the square of the logins before it.
+
+Usage: python benchmarks/usernames.py [--logins 50000] [--scan-logins 500]
+"""
+import argparse, time
+import stubs
+import server
+from room_index import FakeClient
+
+
+def scanUsername(usernames, clientIp, wantName):
+    """
+    createUsername before the username index
+    """
+    username = wantName
+    i = 1
+    if username in usernames.values():
+        tempName = username + f"({i})"
+        while tempName in usernames.values():
+            i += 1
+            tempName = username + f"({i})"
+        username = tempName
+    usernames[clientIp] = username
+    return username
+
+
+def timeScan(logins, wantName):
+    usernames = {}
+    start = time.perf_counter()
+    for i in range(logins):
+        scanUsername(usernames, ('127.0.0.1', 10000 + i), wantName)
+    return time.perf_counter() - start
+
+
+def timeIndex(srv, clients, wantName):
+    start = time.perf_counter()
+    for client in clients:
+        srv.createUsername(client, wantName)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--logins', type=int, default=50000)
+    parser.add_argument('--scan-logins', type=int, default=500)
+    parser.add_argument('--name', default='guest')
+    parser.add_argument('--port', type=int, default=50622)
+    args = parser.parse_args()
+
+    srv = stubs.headlessServer(('127.0.0.1', args.port))
+    clients = [FakeClient(10000 + i) for i in range(args.logins)]
+
+    elapsed = timeIndex(srv, clients, args.name)
+    print(f'index  {args.logins:>7} logins  {elapsed:8.3f} s  {elapsed / args.logins * 1e6:8.2f} us/login')
+    assert len({client.session.username for client in clients}) == args.logins
+
+    elapsed = timeScan(args.scan_logins, args.name)
+    print(f'scan   {args.scan_logins:>7} logins  {elapsed:8.3f} s  {elapsed / args.scan_logins * 1e6:8.2f} us/login')
+
+    # Half leave, the same number log in again and reuse their names
+    leaving = clients[::2]
+    for client in leaving:
+        srv.remove(client)
+    elapsed = timeIndex(srv, leaving, args.name)
+    print(f'rejoin {len(leaving):>7} logins  {elapsed:8.3f} s  {elapsed / len(leaving) * 1e6:8.2f} us/login')
+    assert len({client.session.username for client in clients}) == args.logins
+    assert max(srv.nameIndex.nextSuffix.values()) == args.logins
+
+
+if __name__ == '__main__':
+    main()
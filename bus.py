@@ -0,0 +1,176 @@
+import collections, os, socket, threading
+from packet import *
+from outbox import *
+from _thread import *
+
+"""
+Packets and bytes that can wait to be written to one end of the bus.
+Nothing shared between workers may be dropped, but waiting for room
+would hold up every sender, so an end this far behind is disconnected
+"""
+BUS_OUTBOX_SIZE = 65536
+BUS_OUTBOX_BYTES = 64 * 1024 * 1024
+
+"""
+Opcodes that are relayed between workers. Fields in a payload
+are separated by new lines, a broadcast's text is always last
+"""
+PEER_OPCODES = frozenset((OPCODES["OPCODE_PEER_ROOM"], OPCODES["OPCODE_PEER_JOIN"],
+                          OPCODES["OPCODE_PEER_LEAVE"], OPCODES["OPCODE_PEER_BROADCAST"]))
+
+class BusHub:
+    """
+    Relays peer packets between the worker processes of a cluster
+    over a Unix socket.
+
+    Every packet a worker sends is passed on to every other worker.
+    The hub remembers the rooms and room members so a worker that
+    connects late is sent the current state first, and the members
+    of a worker that goes away are removed from the others.
+
+    The lock guards the shared state, packets are sent once it
+    is released
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+
+        # Connected workers, the rooms created and the
+        # members of each worker, {(room, username): count}
+        self.lock = threading.Lock()
+        self.links = []
+        self.rooms = {}
+        self.members = {}
+
+    def run(self):
+        """
+        Accepts workers until the listener is closed,
+        each worker is read by its own thread
+        """
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            link = QueuedSocket(conn, Outbox(BUS_OUTBOX_SIZE, DISCONNECT, BUS_OUTBOX_BYTES))
+            start_new_thread(self.workerThread, (link,))
+
+    def workerThread(self, link):
+        # Queued under the lock so it goes out before anything
+        # relayed to the new worker, its outbox never blocks
+        with self.lock:
+            messages = [(OPCODES["OPCODE_PEER_ROOM"], room) for room in self.rooms]
+            for members in self.members.values():
+                for (room, username), count in members.items():
+                    messages += [(OPCODES["OPCODE_PEER_JOIN"], f'{room}\n{username}')] * count
+            if messages:
+                link.send(encodePackets(messages))
+            self.links.append(link)
+            self.members[link] = collections.Counter()
+
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = link.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            for decodedPkt in decoder.feed(data):
+                if type(decodedPkt) == tuple and decodedPkt[0] in PEER_OPCODES:
+                    self.relay(link, decodedPkt[0], decodedPkt[2])
+            if decoder.failed:
+                break
+
+        self.drop(link)
+        link.close()
+
+    def relay(self, link, opCode, payload):
+        """
+        Record what the packet changes and pass it on
+        to every worker but the one that sent it
+        """
+        with self.lock:
+            if opCode == OPCODES["OPCODE_PEER_ROOM"]:
+                self.rooms[payload] = None
+            elif opCode == OPCODES["OPCODE_PEER_JOIN"]:
+                self.members[link][tuple(payload.split('\n', 1))] += 1
+            elif opCode == OPCODES["OPCODE_PEER_LEAVE"]:
+                members = self.members[link]
+                key = tuple(payload.split('\n', 1))
+                members[key] -= 1
+                if members[key] <= 0:
+                    del members[key]
+
+            others = [other for other in self.links if other is not link]
+        packet = encodePacket(opCode, payload)
+        for other in others:
+            other.send(packet)
+
+    def drop(self, link):
+        """
+        A worker went away, its users leave their rooms on every other worker
+        """
+        with self.lock:
+            self.links.remove(link)
+            members = self.members.pop(link)
+            others = list(self.links)
+        messages = []
+        for (room, username), count in members.items():
+            messages += [(OPCODES["OPCODE_PEER_LEAVE"], f'{room}\n{username}')] * count
+        if messages:
+            packet = encodePackets(messages)
+            for other in others:
+                other.send(packet)
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class BusLink:
+    """
+    A worker's connection to the hub.
+
+    publish queues a packet for the hub and returns at once,
+    packets from the other workers are handed to the function
+    given to start on a reader thread
+    """
+
+    def __init__(self, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.link = QueuedSocket(sock, Outbox(BUS_OUTBOX_SIZE, DISCONNECT, BUS_OUTBOX_BYTES))
+
+    def publish(self, opCode, payload):
+        self.link.send(encodePacket(opCode, payload))
+
+    def start(self, received):
+        """
+        Call received(OPCODE, PAYLOAD) for every packet from the hub
+        """
+        start_new_thread(self.reader, (received,))
+
+    def reader(self, received):
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = self.link.recv(65536)
+            except OSError:
+                return
+            if not data:
+                return
+            for decodedPkt in decoder.feed(data):
+                if type(decodedPkt) == tuple:
+                    received(decodedPkt[0], decodedPkt[2])
+            if decoder.failed:
+                return
+
+    def close(self):
+        self.link.close()
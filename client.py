@@ -5,14 +5,36 @@ from tkinter import scrolledtext
 from tkinter.constants import END, TRUE
 import tkinter.font as tkFont
 from packet import *
+from dispatch import *
 from _thread import *
 
+"""
+Milliseconds between reads of the server socket when Tk cannot
+watch it for the client (there are no file handlers on Windows)
+"""
+POLL_INTERVAL = 10
+
+"""
+Most bytes read from the server in one turn of the Tk event loop,
+the rest is read on the next turn so the window keeps drawing
+"""
+MAX_READ_PER_TURN = 256 * 1024
+
 class Client:
-    def __init__(self, serverInfo, username, textBox, roomFrame):
+    def __init__(self, serverInfo, username, textBox, roomFrame, eventQueue=None, useCompression=True):
         self.serverInfo = serverInfo
         self.username = username
         self.textBox = textBox
+
+        # Ask for compression if the server offers it
+        self.useCompression = useCompression
+        self.compress = None
         self.roomFrame = roomFrame
+
+        # Widgets are only changed by the GUI thread, the network thread
+        # posts its events to this queue. Without a queue the widgets
+        # are written directly
+        self.eventQueue = eventQueue
         self.style = tkFont.Font(family='Arial', size=15)
         self.running = True
 
@@ -20,10 +42,32 @@ class Client:
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.connect(self.serverInfo)
         self.lastPacket = None
+        self.decoder = FrameDecoder()
         self.roomList = []
         self.userList = []
         self.room = ''
 
+        # Numbers of the oldest and newest room history shown
+        self.oldestHistory = None
+        self.newestHistory = None
+
+        # Room panel widgets, built the first time it is shown
+        self.panel = None
+        self.panelMode = None
+        self.panelRows = []
+
+        # Packets are routed by opcode
+        self.dispatcher = Dispatcher(self.ignore)
+        self.registerHandlers()
+
+        # Set when the server is read from the Tk event loop, writes
+        # the socket cannot take yet wait in pending
+        self.widget = None
+        self.flushEvents = None
+        self.fileHandler = False
+        self.pending = bytearray()
+        self.writeId = None
+
     def getServerMsgs(self):
         """
         Watches the socket for packets from the server and processes them
@@ -46,119 +90,306 @@ class Client:
                         self.printEvent(event, True)
                         self.running = False
                     else:
-                        # Decode the packet
-                        decodedPkt = decodePacket(packet)
+                        # Server closed the connection
+                        if not packet:
+                            event = "DISCONNECTED FROM SERVER"
+                            self.printEvent(event, True)
+                            self.running = False
 
-                        # Decode returned an error print the error for
-                        # the server and sent it back to the client
-                        if type(decodedPkt) == bytes:
-                            opCode, length, errCode = decodePacket(decodedPkt)
-                            event = "<SERVER> ERROR in server packet - " + list(ERRORCODES.keys())[int(errCode)]
-                            self.printEvent(event,True)
+                        # A read can hold several packets or only part of one
+                        for decodedPkt in self.decoder.feed(packet):
+                            self.handlePacket(decodedPkt)
 
-                        else:
-                            self.processMessage(decodedPkt)
+                        # The packets can no longer be told apart
+                        if self.decoder.failed:
+                            event = "DISCONNECTED FROM SERVER"
+                            self.printEvent(event, True)
+                            self.running = False
 
-                    
         
         self.server.close()
 
-    def printEvent(self, event, error=False):
+    def readOnTk(self, widget, flushEvents=None):
+        """
+        Read the server from widget's Tk event loop instead of a thread.
+
+        The socket is made non-blocking and Tk calls readServer when
+        it is readable, where Tk has no file handlers it is polled
+        every POLL_INTERVAL ms. Packets are decoded and handled on the
+        GUI thread, flushEvents is then called to apply the events
+        the batch queued without waiting for the next frame
+        """
+        self.widget = widget
+        self.flushEvents = flushEvents
+        self.server.setblocking(False)
+        try:
+            widget.tk.createfilehandler(self.server, tk.READABLE, self.readServer)
+            self.fileHandler = True
+        except (AttributeError, RuntimeError):
+            self.widget.after(POLL_INTERVAL, self.readServer)
+
+    def readServer(self, *args):
+        """
+        Handle everything the server sent so far as one batch
+        """
+        received = 0
+        while self.running and received < MAX_READ_PER_TURN:
+            try:
+                packet = self.server.recv(MAX_PACKET_SIZE)
+            except BlockingIOError:
+                break
+            # Packet retrieval failed close the connection
+            except OSError:
+                packet = b''
+            if not packet:
+                self.printEvent("DISCONNECTED FROM SERVER", True)
+                self.stopReading()
+                break
+
+            received += len(packet)
+            for decodedPkt in self.decoder.feed(packet):
+                self.handlePacket(decodedPkt)
+
+            # The packets can no longer be told apart
+            if self.decoder.failed:
+                self.printEvent("DISCONNECTED FROM SERVER", True)
+                self.stopReading()
+                break
+
+        if self.flushEvents:
+            self.flushEvents()
+        if self.running and not self.fileHandler:
+            # Read again at once if the batch was cut short
+            delay = 0 if received >= MAX_READ_PER_TURN else POLL_INTERVAL
+            self.widget.after(delay, self.readServer)
+
+    def stopReading(self):
+        self.running = False
+        if self.fileHandler:
+            self.widget.tk.deletefilehandler(self.server)
+            self.fileHandler = False
+        self.server.close()
+
+    def handlePacket(self, decodedPkt):
+        """
+        Process a packet decoded from the server
+        """
+        # Decode returned an error print the error for
+        # the server and sent it back to the client
+        if type(decodedPkt) == bytes:
+            opCode, length, errCode = decodePacket(decodedPkt)
+            event = "<SERVER> ERROR in server packet - " + getErrCode(errCode)
+            self.printEvent(event,True)
+
+        else:
+            self.processMessage(decodedPkt)
+
+    def printEvent(self, event, error=False, when=None):
         """
         Print events to the server window at the time the event occurs.
-        Prints the time the event is given.
+        Prints the time the event is given, or when if it is set.
         Errors print in red everything else in black
         """
         if error:
             config = 'error'
         else:
             config = 'normal' 
-        currTime = time.strftime("%H:%M:%S",time.localtime())
+        line = self.formatLine(event, when)
+
+        # The GUI thread inserts queued lines in batches
+        if self.eventQueue is not None:
+            self.eventQueue.put((self.textBox, line, config))
+            return
+
         self.textBox.configure(state='normal')
-        self.textBox.insert("end",currTime + " - " + event + "\n", f'{config}')
+        self.textBox.insert("end",line, f'{config}')
         self.textBox.tag_config('normal', foreground='black')
         self.textBox.tag_config('error', foreground='red')        
         self.textBox.see("end")
         self.textBox.configure(state='disabled')
+
+    def formatLine(self, event, when=None):
+        currTime = time.strftime("%H:%M:%S",time.localtime(when))
+        return currTime + " - " + event + "\n"
+
+    def runOnGui(self, function):
+        """
+        Run a function that changes widgets on the GUI thread
+        """
+        if self.eventQueue is not None:
+            self.eventQueue.put(function)
+        else:
+            function()
     
     def sendMsg(self,msg):
-        # TODO errors from encoding
         print(msg)
         if self.running:
-            packet = encodePacket(OPCODES["OPCODE_SEND_MSG"],msg)
-            self.send(packet)
+            try:
+                packet = encodePacket(OPCODES["OPCODE_SEND_MSG"],msg,self.compress)
+            # Encoding failed, print why
+            except ValueError as error:
+                self.printEvent("<CLIENT> ERROR ENCODING PACKET - " + str(error), True)
+            else:
+                self.send(packet)
         else:
             self.printEvent("ERROR Cannot send message, no connection to server")
 
-    def sendName(self):
-        packet = encodePacket(OPCODES["OPCODE_HELLO"], self.username)
+    def sendName(self, offers=()):
+        """
+        Send the username, choosing one of the compression
+        modes the server offered
+        """
+        payload = self.username
+        mode = None
+        if self.useCompression and COMPRESS_ZLIB in offers:
+            mode = COMPRESS_ZLIB
+            payload += '\n' + mode
+        packet = encodePacket(OPCODES["OPCODE_HELLO"], payload)
         self.send(packet)
+        self.compress = mode
 
     def processMessage(self, message):
         """
         message - (OPCODE, LENGTH, PAYLOAD)
-        
+
+        The handler for the opcode is found in self.dispatcher
         """
         opCode, length, payload = message
-        error = False
-        event = "<SERVER> "
+        result = self.dispatcher.dispatch(opCode, payload)
+
+        # Nothing to print or a hook dropped the packet
+        if result is None:
+            return
 
+        event, error = result
+        self.printEvent(event,error)
+
+    def registerHandlers(self):
+        """
+        Route each opcode the server can send to its handler,
+        every handler takes the payload and returns (event, error)
+        """
+        handlers = {
+            "OPCODE_ERR": self.serverError,
+            "OPCODE_HELLO": self.hello,
+            "OPCODE_LIST_ROOMS": self.updateRooms,
+            "OPCODE_LIST_USERS": self.updateUsers,
+            "OPCODE_JOIN_ROOM": self.assignRoom,
+            "OPCODE_LEAVE_ROOM": self.leftRoom,
+            "OPCODE_BROADCAST_MSG": self.chatMessage,
+            "OPCODE_USER_JOINED": self.userJoined,
+            "OPCODE_USER_LEFT": self.userLeft,
+            "OPCODE_STATS": self.showStats,
+            "OPCODE_HISTORY": self.historyMessage,
+            "OPCODE_PING": self.pong,
+            "OPCODE_PONG": self.pongReceived,
+        }
+        for name, handler in handlers.items():
+            self.dispatcher.register(OPCODES[name], handler)
+
+    def ignore(self, payload):
+        """
+        Opcodes the server should not send (GET_ROOMS, SEND_MSG...)
+        """
+        return "<SERVER> ", False
+
+    def serverError(self, payload):
         # Server sent error message
-        if opCode == OPCODES["OPCODE_ERR"]:
-            event += "Last packet returned error - "
-            if type(payload) == int:
-                errorMsg = getErrCode(payload)
-                event += errorMsg 
-                if payload == 2 or errorMsg == "ERR_UNKNOWN":
-                    self.resend()
-            else:
-                event += payload
-            error = True
-        # Initial message from server
-        elif opCode == OPCODES["OPCODE_HELLO"]:
+        event = "<SERVER> Last packet returned error - "
+        if type(payload) == int:
+            errorMsg = getErrCode(payload)
+            event += errorMsg 
+            if payload == 2 or errorMsg == "ERR_UNKNOWN":
+                self.resend()
+        else:
             event += payload
-            self.sendName()
-        # TODO server should not send this
-        elif opCode == OPCODES["OPCODE_GET_ROOMS"]:
-            pass
-        # Server sent list of chatrooms
-        elif opCode == OPCODES["OPCODE_LIST_ROOMS"]:
-            event, error = self.updateRooms(payload)
-        # Server sent user list for the room
-        elif opCode == OPCODES["OPCODE_LIST_USERS"]:
-            event, error = self.updateUsers(payload)
-        # TODO server should not send this
-        elif opCode == OPCODES["OPCODE_CREATE_ROOM"]:
-            pass
-        # Assign user to a room
-        elif opCode == OPCODES["OPCODE_JOIN_ROOM"]:
-            event, error = self.assignRoom(payload)
+        return event, True
+
+    def pong(self, payload):
+        # Server checks the connection is alive, answer without
+        # printing or replacing the packet kept for resending
+        self.write(encodePacket(OPCODES["OPCODE_PONG"], payload))
+
+    def pongReceived(self, payload):
+        return None
+
+    def hello(self, payload):
+        # Initial message from server
+        welcome, _, offers = payload.partition('\n')
+        self.sendName(offers.split(','))
+        return "<SERVER> " + welcome, False
+
+    def leftRoom(self, room):
         # Server removed client from room
-        elif opCode == OPCODES["OPCODE_LEAVE_ROOM"]:
-            self.room = ''
-            self.userList.clear()
-            event += f'you left room \"{payload}\"'
-            self.clearText()
-            self.buildRoomFrame()
-        # TODO server should not send this
-        elif opCode == OPCODES["OPCODE_SEND_MSG"]:
-            pass
+        self.room = ''
+        self.userList.clear()
+        self.oldestHistory = None
+        self.newestHistory = None
+        self.runOnGui(self.clearText)
+        self.runOnGui(self.buildRoomFrame)
+        return f'<SERVER> you left room \"{room}\"', False
+
+    def chatMessage(self, payload):
         # Server sent a message for my room
-        elif opCode == OPCODES["OPCODE_BROADCAST_MSG"]:
-            event = payload
-        else:
-            pass
+        return payload, False
 
-        self.printEvent(event,error)
+    def historyMessage(self, payload):
+        """
+        A message sent in the room before it was shown here.
+        The replay after joining is added to the end, pages
+        of older messages are added above everything shown
+        """
+        number, when, text = payload.split('\n', 2)
+        number = int(number)
+        when = float(when)
+        if self.newestHistory is None or number > self.newestHistory:
+            self.newestHistory = number
+            if self.oldestHistory is None:
+                self.oldestHistory = number
+            self.printEvent(text, when=when)
+        elif number < self.oldestHistory:
+            self.oldestHistory = number
+            line = self.formatLine(text, when)
+            self.runOnGui(lambda: self.insertOlder(line))
+
+    def fetchOlder(self):
+        """
+        Ask for the page of messages before the oldest one shown
+        """
+        if self.room != '' and self.oldestHistory and self.oldestHistory > 1:
+            # Queued before asking so it runs before the page arrives
+            self.runOnGui(self.startOlderPage)
+            packet = encodePacket(OPCODES["OPCODE_FETCH_HISTORY"],str(self.oldestHistory))
+            self.send(packet)
+
+    def startOlderPage(self):
+        """
+        A page is inserted in order at the top of the room's messages
+        """
+        self.textBox.mark_set('older', 'historyTop')
+        self.textBox.mark_gravity('older', 'right')
+
+    def insertOlder(self, line):
+        self.textBox.configure(state='normal')
+        self.textBox.insert('older', line, 'normal')
+        self.textBox.configure(state='disabled')
+
+    def showStats(self, payload):
+        # Server metrics that were asked for
+        return "<SERVER> stats\n" + payload, False
 
     def assignRoom(self, room):
         error = False
         self.room = room
         event = f'<SERVER> you joined room \"{self.room}\"'
-        packet = encodePacket(OPCODES["OPCODE_LIST_USERS"],room)
-        self.send(packet)
-        self.clearText()
-        self.buildRoomFrame()
+
+        # The server follows the join with the room's user list
+        # and latest messages
+        self.userList = []
+        self.oldestHistory = None
+        self.newestHistory = None
+        self.runOnGui(self.clearText)
+        self.runOnGui(self.buildRoomFrame)
 
         return event, error
 
@@ -168,37 +399,95 @@ class Client:
         if roomStr:
             self.roomList = roomStr.split(',')
 
-        self.buildRoomFrame()
+        self.runOnGui(self.buildRoomFrame)
         return event,error
 
     def buildRoomFrame(self):
         """
-        Builds either buttons to join or create rooms
+        Shows either the rooms to join or create
         or Usernames for the people in the current room
+
+        The panel is built once and reused, each update only changes
+        the rows that differ. A Listbox only draws its visible rows
+        so long room and user lists stay fast
         """
-        # clear the room Frame
-        for widget in self.roomFrame.winfo_children():
-            widget.destroy()
+        if self.panel is None:
+            self.buildPanel()
 
         # Client not in a room list the rooms
         if self.room == '':
-            tk.Label(self.roomFrame, text="Rooms", font=self.style).pack()
-            for room in self.roomList:
-                tk.Button(self.roomFrame, text=f'{room}', width=15, command=lambda index=f'{room}':self.joinRoom(index)).pack()
-            tk.Label(self.roomFrame, text=' ').pack()
-            newRoom = tk.Entry(self.roomFrame, width=18)
-            newRoom.pack()
-            tk.Button(self.roomFrame, text='Create New Room', width=15, command=lambda:self.createRoom(newRoom.get())).pack()
+            mode, title, items = 'rooms', "Rooms", self.roomList
+            self.userControls.pack_forget()
+            self.roomControls.pack()
         
         # Print Usernames of users in room
         else:
-            tk.Label(self.roomFrame, text=f"{self.room}", font=self.style).pack()
-            users = scrolledtext.ScrolledText(self.roomFrame, width=12, height=22)
-            users.pack()
-            for user in self.userList:
-                users.insert(tk.INSERT,user + '\n')
-            users.configure(state='disabled')
-            tk.Button(self.roomFrame, text='Leave Room', width=15, command=self.leaveRoom).pack()
+            mode, title, items = 'users', f"{self.room}", self.userList
+            self.roomControls.pack_forget()
+            self.userControls.pack()
+
+        self.panelTitle.configure(text=title)
+        if mode != self.panelMode:
+            self.panelMode = mode
+            self.panelRows = []
+            self.panelList.delete(0, END)
+        self.updateRows(items)
+
+    def buildPanel(self):
+        """
+        Create the widgets of the room panel
+        """
+        self.panelTitle = tk.Label(self.roomFrame, font=self.style)
+        self.panelTitle.pack()
+
+        listFrame = tk.Frame(self.roomFrame)
+        listFrame.pack()
+        scroll = tk.Scrollbar(listFrame)
+        scroll.pack(side='right', fill='y')
+        self.panelList = tk.Listbox(listFrame, width=15, height=22, activestyle='none', yscrollcommand=scroll.set)
+        self.panelList.pack(side='left')
+        scroll.configure(command=self.panelList.yview)
+        self.panelList.bind('<ButtonRelease-1>', self.clickRow)
+
+        # Creating rooms is only shown when not in a room
+        self.roomControls = tk.Frame(self.roomFrame)
+        tk.Label(self.roomControls, text=' ').pack()
+        newRoom = tk.Entry(self.roomControls, width=18)
+        newRoom.pack()
+        tk.Button(self.roomControls, text='Create New Room', width=15, command=lambda:self.createRoom(newRoom.get())).pack()
+
+        self.userControls = tk.Frame(self.roomFrame)
+        tk.Button(self.userControls, text='Leave Room', width=15, command=self.leaveRoom).pack()
+        tk.Button(self.userControls, text='Older Messages', width=15, command=self.fetchOlder).pack()
+
+        self.panel = listFrame
+
+    def updateRows(self, items):
+        """
+        Replace only the rows between the first and last
+        difference from what is already shown
+        """
+        rows = self.panelRows
+        start = 0
+        limit = min(len(rows), len(items))
+        while start < limit and rows[start] == items[start]:
+            start += 1
+        end = 0
+        while end < limit - start and rows[-1 - end] == items[-1 - end]:
+            end += 1
+
+        if start < len(rows) - end:
+            self.panelList.delete(start, len(rows) - end - 1)
+        if start < len(items) - end:
+            self.panelList.insert(start, *items[start:len(items) - end])
+        self.panelRows = list(items)
+
+    def clickRow(self, event):
+        """
+        Clicking a room joins it
+        """
+        if self.panelMode == 'rooms' and self.panelRows:
+            self.joinRoom(self.panelRows[self.panelList.nearest(event.y)])
 
     def joinRoom(self, room):
         packet = encodePacket(OPCODES["OPCODE_JOIN_ROOM"],room)
@@ -216,26 +505,59 @@ class Client:
             packet = encodePacket(OPCODES["OPCODE_LEAVE_ROOM"],)
             self.send(packet)
 
+    def requestStats(self):
+        packet = encodePacket(OPCODES["OPCODE_STATS"],)
+        self.send(packet)
+
     def send(self,packet):
         """
         Store the last packet to resend on 
         certain errors
         """
         self.lastPacket = packet
-        self.server.send(packet)
+        self.write(packet)
 
     def resend(self):
         """
         Resend most recent packet
         """
         self.printEvent("<CLIENT> Resent packet",True)
-        self.server.send(self.lastPacket)
+        self.write(self.lastPacket)
+
+    def write(self, data):
+        """
+        Send data to the server. A non-blocking socket may take only
+        part of it, the rest is sent from the Tk event loop
+        """
+        if self.widget is None:
+            self.server.send(data)
+            return
+        self.pending += data
+        self.writePending()
+
+    def writePending(self):
+        self.writeId = None
+        if not self.running:
+            return
+        try:
+            sent = self.server.send(self.pending)
+        except BlockingIOError:
+            sent = 0
+        # The reader notices a broken connection
+        except OSError:
+            sent = len(self.pending)
+        del self.pending[:sent]
+        if self.pending and self.writeId is None:
+            self.writeId = self.widget.after(POLL_INTERVAL, self.writePending)
 
     def clearText(self):
         self.textBox.configure(state='normal')
         self.textBox.delete(1.0,END)
         for i in range(25):
             self.textBox.insert("end","\n")
+        # Older room history is inserted here, below the padding
+        self.textBox.mark_set('historyTop', 'end-1c')
+        self.textBox.mark_gravity('historyTop', 'left')
         self.textBox.see("end")
         self.textBox.configure(state='disabled')
 
@@ -253,5 +575,27 @@ class Client:
             if userStr:
                 self.userList = userStr.split(',')
 
-        self.buildRoomFrame()
+        self.runOnGui(self.buildRoomFrame)
+        return event,error
+
+    def userJoined(self, username):
+        """
+        Add one user to the room's user list
+        """
+        error = False
+        event = f"<SERVER> \"{username}\" joined the room"
+        if username not in self.userList:
+            self.userList = self.userList + [username]
+        self.runOnGui(self.buildRoomFrame)
+        return event,error
+
+    def userLeft(self, username):
+        """
+        Remove one user from the room's user list
+        """
+        error = False
+        event = f"<SERVER> \"{username}\" left the room"
+        if username in self.userList:
+            self.userList = [user for user in self.userList if user != username]
+        self.runOnGui(self.buildRoomFrame)
         return event,error
@@ -0,0 +1,101 @@
+"""
+Runs the chat server as several worker processes sharing one port.
+
+Every worker is a full Server accepting on the same address with
+SO_REUSEPORT, so the kernel spreads new connections over the workers
+and each one can use its own core. Rooms, room members and chat
+messages are shared through a hub process over a Unix socket so users
+on different workers still see each other.
+
+Workers have no window, their events are printed to the terminal.
+
+Usage: python cluster.py [--host 127.0.0.1] [--port 5000] [--workers 4]
+       [--asyncio] [--quiet]
+"""
+import argparse, multiprocessing, os, sys, tempfile, time
+import server
+from bus import *
+
+class ConsoleText:
+    """
+    Stands in for the server's text widgets. Lines inserted are
+    printed with the worker's name when echo is set, every other
+    widget call does nothing
+    """
+
+    def __init__(self, name, echo=True):
+        self.name = name
+        self.echo = echo
+
+    def insert(self, index, *chunks):
+        if self.echo:
+            # chunks are text, tag pairs
+            for text in chunks[::2]:
+                sys.stdout.write(f'[{self.name}] {text}')
+            sys.stdout.flush()
+
+    def __getattr__(self, name):
+        return self.ignore
+
+    def ignore(self, *args, **kwargs):
+        return ''
+
+
+def runHub(busPath, ready):
+    hub = BusHub(busPath)
+    ready.set()
+    hub.run()
+
+
+def runWorker(netInfo, busPath, useAsync, index, quiet, ready):
+    name = f'worker{index}'
+    serverClass = server.AsyncServer if useAsync else server.Server
+    worker = serverClass(netInfo, ConsoleText(name, not quiet), ConsoleText(name, False), ConsoleText(name, False),
+                         reusePort=True, bus=BusLink(busPath), nodeName=name)
+    ready.set()
+    worker.runServer()
+
+
+def startCluster(netInfo, workers, useAsync=False, busPath=None, quiet=False):
+    """
+    Start the hub and the worker processes and wait until every
+    worker is accepting. Returns the processes, the hub first
+    """
+    busPath = busPath or os.path.join(tempfile.gettempdir(), f'chat-bus-{os.getpid()}.sock')
+
+    ready = multiprocessing.Event()
+    hub = multiprocessing.Process(target=runHub, args=(busPath, ready), daemon=True)
+    hub.start()
+    if not ready.wait(10):
+        raise RuntimeError('bus hub failed to start')
+    processes = [hub]
+
+    for i in range(workers):
+        ready = multiprocessing.Event()
+        worker = multiprocessing.Process(target=runWorker, args=(netInfo, busPath, useAsync, i, quiet, ready), daemon=True)
+        worker.start()
+        if not ready.wait(10) or not worker.is_alive():
+            raise RuntimeError(f'worker {i} failed to start')
+        processes.append(worker)
+    return processes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--asyncio', action='store_true', help="serve clients from an asyncio event loop in each worker")
+    parser.add_argument('--bus', help="path of the hub's Unix socket")
+    parser.add_argument('--quiet', action='store_true', help="do not print server events")
+    args = parser.parse_args()
+
+    processes = startCluster((args.host, args.port), args.workers, args.asyncio, args.bus, args.quiet)
+    print(f'{args.workers} workers serving {args.host}:{args.port}')
+    try:
+        while all(process.is_alive() for process in processes):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for process in processes:
+        process.terminate()
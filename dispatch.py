@@ -0,0 +1,65 @@
+import time
+
+class Dispatcher:
+    """
+    Routes a decoded packet to the handler registered for its opcode
+    with one dict lookup.
+
+    Hooks run around every handler without the handler knowing:
+    before hooks are called as hook(opCode, args) and can return False
+    to drop the packet, for rate limiting. After hooks are called as
+    hook(opCode, args, result, seconds) with the handler's run time,
+    for profiling and tracing. With no hooks the handler is called
+    directly and nothing is timed.
+    """
+
+    def __init__(self, default=None):
+        # OPCODE -> handler, opcodes without one go to the default
+        self.handlers = {}
+        self.default = default
+        self.beforeHooks = []
+        self.afterHooks = []
+
+    def register(self, opCode, handler):
+        """
+        Set the handler for an opcode, replacing any before it
+        """
+        self.handlers[opCode] = handler
+
+    def unregister(self, opCode):
+        self.handlers.pop(opCode, None)
+
+    def before(self, hook):
+        self.beforeHooks.append(hook)
+
+    def after(self, hook):
+        self.afterHooks.append(hook)
+
+    def removeHook(self, hook):
+        """
+        Remove a hook added with before or after
+        """
+        for hooks in (self.beforeHooks, self.afterHooks):
+            if hook in hooks:
+                hooks.remove(hook)
+
+    def dispatch(self, opCode, *args):
+        """
+        Call the handler for opCode with args and return its result,
+        None when a before hook dropped the packet
+        """
+        handler = self.handlers.get(opCode, self.default)
+        if not self.beforeHooks and not self.afterHooks:
+            return handler(*args)
+
+        for hook in self.beforeHooks:
+            if hook(opCode, args) is False:
+                return None
+
+        start = time.perf_counter()
+        result = handler(*args)
+        seconds = time.perf_counter() - start
+
+        for hook in self.afterHooks:
+            hook(opCode, args, result, seconds)
+        return result
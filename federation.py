@@ -0,0 +1,334 @@
+"""
+Links chat server nodes into a network that shares rooms.
+
+Each node is a Server whose bus is a Federation. Nodes connect to
+each other over TCP and speak the peer opcodes, every payload starts
+with a message ID and the node the message came from:
+
+    MESSAGE_ID \\n ORIGIN \\n FIELDS
+
+A message ID is NODE:EPOCH:SEQUENCE, the epoch is picked each time
+the node starts so a restarted node's messages are not taken for
+ones seen before it restarted.
+
+Room creation and membership are flooded to every node, a message
+already seen (by ID) or a change already known is not passed on again
+so links may form loops. Broadcasts only travel down links that lead
+to a node with members in the room.
+
+Usage: python federation.py --node A --port 5000 --link-port 6000
+       [--peer 127.0.0.1:6001 ...] [--asyncio] [--quiet]
+"""
+import argparse, collections, os, socket, threading, time
+from packet import *
+from outbox import *
+from bus import BUS_OUTBOX_SIZE, BUS_OUTBOX_BYTES, PEER_OPCODES
+from _thread import *
+
+"""
+Message IDs remembered to drop messages that come back around a loop
+"""
+SEEN_SIZE = 65536
+
+"""
+Seconds between attempts to connect to a peer that is down
+"""
+RECONNECT_INTERVAL = 2
+
+class NodeLink:
+    """
+    A connection to another node, its ID is known once
+    the other side sends OPCODE_PEER_LINK
+    """
+
+    def __init__(self, sock):
+        self.sock = QueuedSocket(sock, Outbox(BUS_OUTBOX_SIZE, DISCONNECT, BUS_OUTBOX_BYTES))
+        self.node = None
+
+    def send(self, packet):
+        self.sock.send(packet)
+
+    def close(self):
+        self.sock.close()
+
+
+class Federation:
+    """
+    The bus of one node in a network of nodes, used by Server
+    like the cluster's BusLink (publish and start).
+
+    The lock guards the shared state only. Packets for other nodes
+    and changes for the local server are collected under it and
+    handed on once it is released
+    """
+
+    def __init__(self, node, linkAddr, peers=()):
+        self.node = node
+        self.linkAddr = linkAddr
+        self.peers = list(peers)
+        self.received = None
+
+        self.lock = threading.Lock()
+        self.links = []
+        self.epoch = os.urandom(4).hex()
+        self.sequence = 0
+        self.closed = False
+        self.seen = collections.OrderedDict()
+
+        # Shared state, rooms and every member on the network with the
+        # link they were learned through ((origin, room, username) -> link,
+        # None for this node's members). interest counts the members of
+        # each room behind each link
+        self.rooms = {}
+        self.members = {}
+        self.interest = {}
+
+        # Counters
+        self.duplicates = 0
+        self.forwarded = 0
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(linkAddr)
+        self.listener.listen(16)
+
+    def start(self, received):
+        """
+        Call received(OPCODE, FIELDS) for every change from the network,
+        accept links from other nodes and connect to the peers
+        """
+        self.received = received
+        start_new_thread(self.acceptLinks, ())
+        for peer in self.peers:
+            start_new_thread(self.connectPeer, (peer,))
+
+    def publish(self, opCode, fields):
+        """
+        Send a change made on this node to the network
+        """
+        with self.lock:
+            msgId = self.nextId()
+            if not self.apply(None, opCode, self.node, fields):
+                return
+            sends = self.forward(None, opCode, f'{msgId}\n{self.node}\n{fields}', fields)
+        self.deliver(sends)
+
+    def acceptLinks(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            start_new_thread(self.linkThread, (NodeLink(sock),))
+
+    def connectPeer(self, peer):
+        """
+        Keep a link to the peer up, reconnecting when it drops
+        """
+        while not self.closed:
+            try:
+                sock = socket.create_connection(peer)
+            except OSError:
+                time.sleep(RECONNECT_INTERVAL)
+                continue
+            if self.closed:
+                sock.close()
+                return
+            self.linkThread(NodeLink(sock))
+            time.sleep(RECONNECT_INTERVAL)
+
+    def linkThread(self, link):
+        """
+        Read one link until it closes. The first packet
+        each side sends is its node ID
+        """
+        link.send(encodePacket(OPCODES["OPCODE_PEER_LINK"], self.node))
+        decoder = FrameDecoder()
+        while True:
+            try:
+                data = link.sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            for decodedPkt in decoder.feed(data):
+                if type(decodedPkt) != tuple:
+                    continue
+                opCode, length, payload = decodedPkt
+                if opCode == OPCODES["OPCODE_PEER_LINK"]:
+                    if not self.linkUp(link, payload):
+                        link.close()
+                        return
+                elif opCode in PEER_OPCODES and link.node:
+                    self.linkReceived(link, opCode, payload)
+            if decoder.failed:
+                break
+
+        self.linkDown(link)
+        link.close()
+
+    def linkUp(self, link, node):
+        """
+        Add the link and send the other node everything this node knows.
+        Returns False for a second link to a node already linked
+        """
+        with self.lock:
+            if node == self.node or any(other.node == node for other in self.links):
+                return False
+            link.node = node
+            self.links.append(link)
+            self.interest[link] = collections.Counter()
+
+            # Queued under the lock so it goes out before anything
+            # forwarded to the new link, its outbox never blocks
+            messages = [(OPCODES["OPCODE_PEER_ROOM"], self.wrap(self.node, room)) for room in self.rooms]
+            for (origin, room, username), via in self.members.items():
+                if via is not link:
+                    messages.append((OPCODES["OPCODE_PEER_JOIN"], self.wrap(origin, f'{room}\n{username}')))
+            if messages:
+                link.send(encodePackets(messages))
+        return True
+
+    def linkDown(self, link):
+        """
+        Members behind a lost link leave their rooms,
+        the rest of the network is told they left
+        """
+        with self.lock:
+            if link not in self.links:
+                return
+            self.links.remove(link)
+            del self.interest[link]
+            sends = []
+            changes = []
+            for key, via in list(self.members.items()):
+                if via is link:
+                    origin, room, username = key
+                    fields = f'{room}\n{username}'
+                    if self.apply(link, OPCODES["OPCODE_PEER_LEAVE"], origin, fields):
+                        changes.append((OPCODES["OPCODE_PEER_LEAVE"], fields))
+                    sends += self.forward(link, OPCODES["OPCODE_PEER_LEAVE"], self.wrap(origin, fields), fields)
+        self.deliver(sends, changes)
+
+    def linkReceived(self, link, opCode, payload):
+        msgId, origin, fields = payload.split('\n', 2)
+        with self.lock:
+            if msgId in self.seen:
+                self.duplicates += 1
+                return
+            self.remember(msgId)
+            if not self.apply(link, opCode, origin, fields):
+                return
+            sends = self.forward(link, opCode, payload, fields)
+        self.deliver(sends, [(opCode, fields)])
+
+    def apply(self, link, opCode, origin, fields):
+        """
+        Record a change. Returns False if nothing changed,
+        the message then goes no further
+        """
+        if opCode == OPCODES["OPCODE_PEER_ROOM"]:
+            if fields in self.rooms:
+                return False
+            self.rooms[fields] = None
+        elif opCode in (OPCODES["OPCODE_PEER_JOIN"], OPCODES["OPCODE_PEER_LEAVE"]):
+            room, username = fields.split('\n', 1)
+            key = (origin, room, username)
+            if opCode == OPCODES["OPCODE_PEER_JOIN"]:
+                if key in self.members:
+                    return False
+                self.members[key] = link
+                if link:
+                    self.interest[link][room] += 1
+            else:
+                if key not in self.members:
+                    return False
+                via = self.members.pop(key)
+                if via in self.interest:
+                    self.interest[via][room] -= 1
+        return True
+
+    def forward(self, link, opCode, payload, fields):
+        """
+        The (LINK, PACKET) sends that pass a message on to every other
+        link, broadcasts only to the links with members of the room
+        behind them
+        """
+        packet = encodePacket(opCode, payload)
+        room = fields.split('\n', 1)[0]
+        sends = []
+        for other in self.links:
+            if other is link:
+                continue
+            if opCode == OPCODES["OPCODE_PEER_BROADCAST"] and self.interest[other][room] <= 0:
+                continue
+            self.forwarded += 1
+            sends.append((other, packet))
+        return sends
+
+    def deliver(self, sends, changes=()):
+        """
+        Send the packets and hand the changes from other nodes to
+        the local server, called without the lock held
+        """
+        for link, packet in sends:
+            link.send(packet)
+        if self.received:
+            for opCode, fields in changes:
+                self.received(opCode, fields)
+
+    def wrap(self, origin, fields):
+        """
+        Payload for a message this node sends on behalf of origin
+        """
+        return f'{self.nextId()}\n{origin}\n{fields}'
+
+    def nextId(self):
+        """
+        A new message ID, remembered so it is not taken back
+        """
+        self.sequence += 1
+        msgId = f'{self.node}:{self.epoch}:{self.sequence}'
+        self.remember(msgId)
+        return msgId
+
+    def remember(self, msgId):
+        self.seen[msgId] = None
+        if len(self.seen) > SEEN_SIZE:
+            self.seen.popitem(last=False)
+
+    def close(self):
+        """
+        Stop accepting and making links and close the ones open
+        """
+        self.closed = True
+        self.listener.close()
+        for link in list(self.links):
+            link.close()
+
+
+def parseAddr(text):
+    host, _, port = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+if __name__ == "__main__":
+    import server
+    from cluster import ConsoleText
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--node', required=True, help="name of this node")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000, help="port clients connect to")
+    parser.add_argument('--link-port', type=int, default=6000, help="port other nodes connect to")
+    parser.add_argument('--peer', action='append', default=[], type=parseAddr, help="HOST:PORT of a node to link to")
+    parser.add_argument('--asyncio', action='store_true', help="serve clients from an asyncio event loop")
+    parser.add_argument('--quiet', action='store_true', help="do not print server events")
+    args = parser.parse_args()
+
+    federation = Federation(args.node, (args.host, args.link_port), args.peer)
+    serverClass = server.AsyncServer if args.asyncio else server.Server
+    node = serverClass((args.host, args.port), ConsoleText(args.node, not args.quiet),
+                       ConsoleText(args.node, False), ConsoleText(args.node, False), bus=federation,
+                       nodeName=args.node)
+    node.runServer()
@@ -1,12 +1,27 @@
-import re, queue, server, client, socket
+import re, argparse, queue, server, client, socket
+from lifecycle import HEARTBEAT_INTERVAL, IDLE_TIMEOUT
 import tkinter as tk
 import tkinter.font as tkFont
 from tkinter import Widget, scrolledtext
 from _thread import *
 
+"""
+Most times per second queued network events are drawn, and the most
+events applied in one frame so a flood cannot freeze the window
+"""
+GUI_FPS = 30
+MAX_EVENTS_PER_FRAME = 5000
+
+"""
+Lines kept in the server and client logs. Trimming waits until
+the log is a tenth over the limit so it happens in large chunks
+"""
+SCROLLBACK_LINES = 10000
+
 class Gui:
 
-    def __init__(self, root):
+    def __init__(self, root, useAsync=False, scrollback=SCROLLBACK_LINES, historyFile=None, metricsFile=None, metricsSocket=None,
+                 roomHistory=None, snapshot=None, tkReader=False, heartbeat=HEARTBEAT_INTERVAL, idleTimeout=IDLE_TIMEOUT):
         # Window setup
         self.root = root
         self.root.resizable(False, False)
@@ -18,9 +33,40 @@ class Gui:
         # Network info should be a tuple (IP, PORT)
         self.netInfo = None
 
+        # Serve clients from an asyncio loop instead of a thread each
+        self.useAsync = useAsync
+
+        # Read the server from the Tk event loop instead of a thread
+        self.tkReader = tkReader
+
+        # Log size limit, 0 keeps every line. The full log can
+        # also be appended to a file
+        self.scrollback = scrollback
+        self.history = open(historyFile, 'a', encoding='utf-8') if historyFile else None
+
+        # Where the server's metrics are exported, in Prometheus format
+        self.metricsFile = metricsFile
+        self.metricsSocket = metricsSocket
+
+        # Directory the server keeps each room's messages in
+        self.roomHistory = roomHistory
+
+        # File the server's rooms are saved to and restored from
+        self.snapshot = snapshot
+
+        # Seconds of silence before the server pings a client
+        # and before it closes the connection
+        self.heartbeat = heartbeat
+        self.idleTimeout = idleTimeout
+        self.server = None
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
         # Show first menu 
         self.startUp()
 
+        # Start applying events posted by the network threads
+        self.root.after(1000 // GUI_FPS, self.drainQueue)
+
         
     def startUp(self):
         """
@@ -35,6 +81,16 @@ class Gui:
         tk.Button(self.frame, text='Server', font=self.style, command= lambda: self.getNetInfo(True)).place(x=100, y=100, width=100)
         tk.Button(self.frame, text='Client', font=self.style, command= lambda: self.getNetInfo(False)).place(x=250, y=100, width=100)
     
+    def close(self):
+        """
+        Window closed, save the server's rooms before exiting
+        """
+        try:
+            if self.server:
+                self.server.saveSnapshot()
+        finally:
+            self.root.destroy()
+
     def clearFrame(self):
         """
         Clears the all the contents of the  main frame
@@ -140,7 +196,14 @@ class Gui:
         for i in range(25):
             serverText.insert("end","\n")
         serverText.see("end")
-        self.server = server.Server(self.netInfo, serverText, roomText, userText)
+        self.logWidget(serverText)
+        serverClass = server.AsyncServer if self.useAsync else server.Server
+        self.server = serverClass(self.netInfo, serverText, roomText, userText, self.queue, historyDir=self.roomHistory,
+                                  snapshotPath=self.snapshot, heartbeat=self.heartbeat, idleTimeout=self.idleTimeout)
+        if self.metricsFile:
+            self.server.metrics.exportFile(self.metricsFile)
+        if self.metricsSocket:
+            self.server.metrics.serveSocket(self.metricsSocket)
         start_new_thread(self.server.runServer,())
 
     def startClient(self, username):
@@ -157,14 +220,83 @@ class Gui:
         for i in range(25):
             clientText.insert("end","\n")
         clientText.see("end")
+        self.logWidget(clientText)
         inputText = tk.Text(self.frame,height=5,width=74)
         inputText.grid(row=2,column=0)
         tk.Button(self.frame, text='Send', height=3,font=self.style, command=sendMsg).grid(row=2, column=1)
+        tk.Button(self.frame, text='Stats', font=self.style, command=lambda: self.client.requestStats()).grid(row=3, column=1)
         roomFrame = tk.Frame(self.frame)
         roomFrame.grid(row=0,column=3,rowspan=2, sticky='n')
-        self.client = client.Client(self.netInfo, username, clientText, roomFrame)
-        start_new_thread(self.client.getServerMsgs,())
+        self.client = client.Client(self.netInfo, username, clientText, roomFrame, self.queue)
+        if self.tkReader:
+            self.client.readOnTk(self.root, self.applyQueue)
+        else:
+            start_new_thread(self.client.getServerMsgs,())
     
+    def drainQueue(self):
+        """
+        Apply the events posted to self.queue every frame
+        """
+        self.applyQueue()
+        self.root.after(1000 // GUI_FPS, self.drainQueue)
+
+    def applyQueue(self):
+        """
+        Apply the events network threads posted to self.queue.
+
+        Log lines are (widget, text, tag) and all the lines for one
+        widget are inserted with a single call and scrolled once.
+        Anything else posted is a function to run on this thread.
+        """
+        lines = {}
+        try:
+            for i in range(MAX_EVENTS_PER_FRAME):
+                item = self.queue.get_nowait()
+                if callable(item):
+                    # Keep the order of lines and widget changes
+                    self.writeLines(lines)
+                    lines = {}
+                    item()
+                else:
+                    textBox, text, tag = item
+                    lines.setdefault(textBox, []).extend((text, tag))
+        except queue.Empty:
+            pass
+        self.writeLines(lines)
+
+    def writeLines(self, lines):
+        """
+        Insert batched log lines, lines maps a widget to a flat
+        list of text and tag pairs
+        """
+        for textBox, pairs in lines.items():
+            textBox.configure(state='normal')
+            textBox.insert("end", *pairs)
+            self.trimLines(textBox)
+            textBox.see("end")
+            textBox.configure(state='disabled')
+
+            if self.history:
+                self.history.write(''.join(pairs[::2]))
+                self.history.flush()
+
+    def trimLines(self, textBox):
+        """
+        Drop the oldest lines once the log passes the scrollback limit
+        """
+        if not self.scrollback:
+            return
+        count = int(textBox.index('end-1c').split('.')[0])
+        if count > self.scrollback + self.scrollback // 10:
+            textBox.delete('1.0', f'{count - self.scrollback + 1}.0')
+
+    def logWidget(self, textBox):
+        """
+        Configure the tags used when printing events once
+        """
+        textBox.tag_config('normal', foreground='black')
+        textBox.tag_config('error', foreground='red')
+
     def update(self, textBox, message):
         textBox.configure(state='normal')
         textBox.insert('end',message)
@@ -172,7 +304,23 @@ class Gui:
         textBox.configure(state='normal')
     
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Internet Relay Chat")
+    parser.add_argument('--asyncio', action='store_true', help="serve clients from an asyncio event loop")
+    parser.add_argument('--tk-reader', action='store_true', help="client reads the server from the Tk event loop, not a thread")
+    parser.add_argument('--scrollback', type=int, default=SCROLLBACK_LINES, help="lines kept in the log, 0 keeps all")
+    parser.add_argument('--history', help="append the full log to this file")
+    parser.add_argument('--metrics-file', help="write the server metrics to this file every few seconds")
+    parser.add_argument('--metrics-socket', help="serve the server metrics on this Unix socket")
+    parser.add_argument('--room-history', help="keep every room's messages in this directory")
+    parser.add_argument('--snapshot', help="save the server's rooms to this file and restore them on start")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, help="seconds a client may be silent before it is pinged, 0 never pings")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, help="seconds a client may be silent before it is disconnected, 0 never disconnects")
+    args = parser.parse_args()
+
     root = tk.Tk()
-    window = Gui(root)
+    window = Gui(root, useAsync=args.asyncio, scrollback=args.scrollback, historyFile=args.history,
+                 metricsFile=args.metrics_file, metricsSocket=args.metrics_socket,
+                 roomHistory=args.room_history, snapshot=args.snapshot, tkReader=args.tk_reader,
+                 heartbeat=args.heartbeat, idleTimeout=args.idle_timeout)
 
     tk.mainloop()
\ No newline at end of file
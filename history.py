@@ -0,0 +1,204 @@
+import array, collections, hashlib, mmap, os, struct, threading, time
+
+"""
+Messages of each room kept in memory, the newest are replayed
+to users who join and the rest are read from the room's file
+"""
+HISTORY_RING = 256
+
+"""
+Most bytes of text the ring of one room holds, a room of long
+messages keeps fewer of them in memory
+"""
+HISTORY_RING_BYTES = 4 * 1024 * 1024
+
+"""
+Messages replayed when a user joins a room
+and sent for each request for older messages
+"""
+HISTORY_REPLAY = 50
+HISTORY_PAGE = 50
+
+"""
+Most bytes of text replayed or sent for one request, the newest
+message is always sent so paging never stops early
+"""
+HISTORY_BYTES = 256 * 1024
+
+"""
+Each message in a room's file is stored as the time it was sent
+and its length followed by the UTF-8 text
+"""
+RECORD_FMT = '=dI'
+RECORD_STRUCT = struct.Struct(RECORD_FMT)
+RECORD_SIZE = RECORD_STRUCT.size
+
+class RoomHistory:
+    """
+    The messages sent in one room, numbered from 1.
+
+    The newest are kept in a ring in memory. When a directory is given
+    every message is also appended to the room's segment file, which is
+    memory-mapped to read older messages so a whole log is never loaded.
+    Only the file offset of each message is kept in memory. The file is
+    named by a hash of the room name, which may be longer than a file
+    name can be.
+
+    Without a file, count continues the numbering of a history
+    restored from a snapshot
+    """
+
+    def __init__(self, room, directory=None, ringSize=HISTORY_RING, count=0, ringBytes=HISTORY_RING_BYTES):
+        self.room = room
+        # The size of each message in the ring is kept beside it
+        self.ring = collections.deque(maxlen=ringSize)
+        self.sizes = collections.deque(maxlen=ringSize)
+        self.ringBytes = ringBytes
+        self.size = 0
+        # Without a file numbering carries on from count,
+        # a room's file always knows its own count
+        self.count = count
+        self.lock = threading.Lock()
+
+        # Segment file and the offset of every message in it
+        self.fd = None
+        self.map = None
+        self.offsets = array.array('Q')
+        if directory:
+            self.path = os.path.join(directory, segmentName(room))
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            self.load()
+
+    def load(self):
+        """
+        Index the messages already in the file and fill the ring
+        with the newest. A message only partly written is cut off
+        """
+        size = os.fstat(self.fd).st_size
+        self.count = 0
+        if not size:
+            return
+        self.remap()
+        offset = 0
+        while offset + RECORD_SIZE <= size:
+            when, length = RECORD_STRUCT.unpack_from(self.map, offset)
+            if offset + RECORD_SIZE + length > size:
+                break
+            self.offsets.append(offset)
+            offset += RECORD_SIZE + length
+        if offset < size:
+            self.map.close()
+            self.map = None
+            os.ftruncate(self.fd, offset)
+        self.count = len(self.offsets)
+        first = max(1, self.count - self.ring.maxlen + 1)
+        for message in self.readFile(first, self.count + 1, self.ringBytes):
+            self.keep(message, len(message[2].encode()))
+
+    def append(self, text, when=None):
+        """
+        Add a message, returns its number
+        """
+        when = time.time() if when is None else when
+        data = text.encode()
+        with self.lock:
+            self.count += 1
+            self.keep((self.count, when, text), len(data))
+            if self.fd is not None:
+                self.offsets.append(os.lseek(self.fd, 0, os.SEEK_END))
+                os.write(self.fd, RECORD_STRUCT.pack(when, len(data)) + data)
+            return self.count
+
+    def keep(self, message, size):
+        """
+        Add a message to the ring, the oldest are dropped
+        while the ring holds more than ringBytes
+        """
+        if len(self.ring) == self.ring.maxlen:
+            self.size -= self.sizes[0]
+        self.ring.append(message)
+        self.sizes.append(size)
+        self.size += size
+        while self.size > self.ringBytes and len(self.ring) > 1:
+            self.ring.popleft()
+            self.size -= self.sizes.popleft()
+
+    def recent(self, count=HISTORY_REPLAY, maxBytes=HISTORY_BYTES):
+        """
+        The newest count messages as (NUMBER, TIME, TEXT), oldest first
+        """
+        return self.before(self.count + 1, count, maxBytes)
+
+    def before(self, number, count=HISTORY_PAGE, maxBytes=HISTORY_BYTES):
+        """
+        Up to count messages sent before message number, oldest first.
+        Older messages are left out once maxBytes of text are taken
+        """
+        with self.lock:
+            end = min(number, self.count + 1)
+            start = max(1, end - count)
+            if start >= end:
+                return []
+            ringStart = self.ring[0][0] if self.ring else end
+            if start >= ringStart or self.fd is None:
+                first = max(start, ringStart) - ringStart
+                stop = max(0, end - ringStart)
+                taken = 0
+                for i in range(stop - 1, first - 1, -1):
+                    taken += self.sizes[i]
+                    if taken > maxBytes and i < stop - 1:
+                        first = i + 1
+                        break
+                return [self.ring[i] for i in range(first, stop)]
+            return self.readFile(start, end, maxBytes)
+
+    def readFile(self, start, end, maxBytes=None):
+        """
+        Read messages start to end - 1 from the mapped file, newest
+        first until maxBytes of text are read. The map is grown
+        when the file has
+        """
+        last = self.offsets[end - 2]
+        if self.map is None or last + RECORD_SIZE > len(self.map):
+            self.remap()
+        messages = []
+        taken = 0
+        for number in range(end - 1, start - 1, -1):
+            offset = self.offsets[number - 1]
+            when, length = RECORD_STRUCT.unpack_from(self.map, offset)
+            taken += length
+            if maxBytes is not None and taken > maxBytes and messages:
+                break
+            if offset + RECORD_SIZE + length > len(self.map):
+                self.remap()
+            text = self.map[offset + RECORD_SIZE:offset + RECORD_SIZE + length].decode()
+            messages.append((number, when, text))
+        messages.reverse()
+        return messages
+
+    def remap(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def segmentName(room):
+    """
+    File name of a room's segment file
+    """
+    return hashlib.sha1(room.encode()).hexdigest() + '.log'
+
+
+def historyPayload(number, when, text):
+    """
+    OPCODE_HISTORY payload, NUMBER \\n TIME \\n TEXT
+    """
+    return f'{number}\n{when:.3f}\n{text}'
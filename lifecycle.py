@@ -0,0 +1,102 @@
+import heapq, itertools, threading, time
+
+"""
+Seconds a client may be silent before it is sent OPCODE_PING,
+and before its connection is closed. 0 turns either off
+"""
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 90
+
+"""
+Longest the checker sleeps, new connections are
+looked at no later than this after they come due
+"""
+CHECK_INTERVAL = 1
+
+class Lifecycle:
+    """
+    Watches every client connection for silence.
+
+    Each connection has one entry in a heap ordered by the next time
+    it must be looked at. A packet only sets session.lastSeen, the
+    entry is moved when it comes due, so traffic costs no heap work.
+    A client silent for the heartbeat interval is pinged, one silent
+    for the idle timeout is handed to reap, once
+    """
+
+    def __init__(self, ping, reap, heartbeat=HEARTBEAT_INTERVAL, idleTimeout=IDLE_TIMEOUT):
+        self.ping = ping
+        self.reap = reap
+        self.heartbeat = heartbeat
+        self.idleTimeout = idleTimeout
+        self.enabled = bool(heartbeat or idleTimeout)
+
+        # (DUE, ORDER, CLIENT), order breaks ties between clients
+        self.heap = []
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+
+        # Counters
+        self.pinged = 0
+        self.reaped = 0
+
+    def watch(self, client):
+        """
+        Start watching a newly accepted client
+        """
+        session = client.session
+        session.lastSeen = session.lastPing = time.monotonic()
+        if self.enabled:
+            with self.lock:
+                heapq.heappush(self.heap, (self.due(session), next(self.order), client))
+
+    def due(self, session):
+        """
+        Next time the client needs a ping or has to be reaped
+        """
+        times = []
+        if self.heartbeat:
+            times.append(max(session.lastSeen, session.lastPing) + self.heartbeat)
+        if self.idleTimeout:
+            times.append(session.lastSeen + self.idleTimeout)
+        return min(times)
+
+    def expire(self):
+        """
+        Ping or reap every client that came due. Returns the
+        seconds until the next check
+        """
+        now = time.monotonic()
+        ping, reap = [], []
+        with self.lock:
+            heap = self.heap
+            while heap and heap[0][0] <= now:
+                _, _, client = heapq.heappop(heap)
+                session = client.session
+                if session.closed:
+                    continue
+                if self.idleTimeout and now - session.lastSeen >= self.idleTimeout:
+                    reap.append(client)
+                    continue
+                if self.heartbeat and now - max(session.lastSeen, session.lastPing) >= self.heartbeat:
+                    session.lastPing = now
+                    ping.append(client)
+                heapq.heappush(heap, (self.due(session), next(self.order), client))
+            delay = heap[0][0] - now if heap else CHECK_INTERVAL
+
+        # Sending and closing happen outside the lock
+        for client in ping:
+            self.pinged += 1
+            self.ping(client)
+        for client in reap:
+            self.reaped += 1
+            self.reap(client)
+        return min(max(delay, 0), CHECK_INTERVAL)
+
+    def run(self):
+        """
+        Check the clients until the process ends,
+        for servers with no event loop
+        """
+        while self.enabled:
+            time.sleep(self.expire())
@@ -0,0 +1,220 @@
+import bisect, os, socket, time
+from packet import *
+from _thread import *
+
+"""
+Upper bounds in seconds of the processing time histogram buckets
+"""
+PROCESSING_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                      0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+"""
+Upper bounds of the fan-out size histogram buckets, in recipients
+"""
+FANOUT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+"""
+Seconds between writes of the metrics file
+"""
+EXPORT_INTERVAL = 10
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, the last bucket
+    holds everything above the largest bound
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters and histograms kept by a server.
+
+    Recording is a few dict and list updates with no locking so it
+    can stay on under load. Increments racing between client threads
+    can very rarely be lost, which is fine for monitoring.
+
+    render returns everything in the Prometheus text format.
+    """
+
+    def __init__(self, prefix='chat'):
+        self.prefix = prefix
+        self.started = time.time()
+        self.connections = 0
+
+        # Every opcode and error code is listed even while zero
+        self.packetsIn = dict.fromkeys(VALID_OPCODES, 0)
+        self.bytesIn = 0
+        self.packetsOut = dict.fromkeys(VALID_OPCODES, 0)
+        self.bytesOut = dict.fromkeys(VALID_OPCODES, 0)
+        self.decodeErrors = dict.fromkeys(VALID_ERRORS, 0)
+        self.processing = {op: Histogram(PROCESSING_BUCKETS) for op in VALID_OPCODES}
+        self.fanout = {op: Histogram(FANOUT_BUCKETS) for op in VALID_OPCODES}
+
+        # Values read from their owner when rendered,
+        # name -> (help, function)
+        self.gauges = {}
+
+        # The last data sent and its frames, a fan-out sends the same
+        # object to every client so it is only parsed once
+        self.lastSent = (None, ())
+
+    def gauge(self, name, help, function):
+        """
+        Register a value that is read when the metrics are rendered
+        """
+        self.gauges[name] = (help, function)
+
+    def connected(self):
+        self.connections += 1
+
+    def read(self, size):
+        """
+        size bytes were read from a client socket. Counted as they
+        arrive since a read can hold several packets or part of one
+        """
+        self.bytesIn += size
+
+    def received(self, opCode):
+        """
+        A packet was decoded
+        """
+        self.packetsIn[opCode] += 1
+
+    def decodeError(self, errCode):
+        self.decodeErrors[errCode] += 1
+
+    def processed(self, opCode, seconds):
+        self.processing[opCode].observe(seconds)
+
+    def fannedOut(self, opCode, size):
+        self.fanout[opCode].observe(size)
+
+    def sent(self, data):
+        """
+        Count the packets in data queued for a client.
+        data can hold several packets or the fragments of one
+        """
+        last = self.lastSent
+        if last[0] is not data:
+            last = self.lastSent = (data, splitFrames(data))
+        for opCode, size in last[1]:
+            self.packetsOut[opCode] += 1
+            self.bytesOut[opCode] += size
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        p = self.prefix
+        lines = []
+
+        def header(name, kind, help):
+            lines.append(f'# HELP {p}_{name} {help}')
+            lines.append(f'# TYPE {p}_{name} {kind}')
+
+        def byOpcode(name, help, values):
+            header(name, 'counter', help)
+            for op, value in sorted(values.items()):
+                lines.append(f'{p}_{name}{{opcode="{getOpCode(op)}"}} {value}')
+
+        def histograms(name, help, values):
+            header(name, 'histogram', help)
+            for op, hist in sorted(values.items()):
+                label = f'opcode="{getOpCode(op)}"'
+                total = 0
+                for bound, count in zip(hist.bounds + ('+Inf',), hist.counts):
+                    total += count
+                    lines.append(f'{p}_{name}_bucket{{{label},le="{bound}"}} {total}')
+                lines.append(f'{p}_{name}_sum{{{label}}} {hist.sum}')
+                lines.append(f'{p}_{name}_count{{{label}}} {hist.count}')
+
+        header('start_time_seconds', 'gauge', 'Unix time the server started')
+        lines.append(f'{p}_start_time_seconds {self.started}')
+        header('connections_total', 'counter', 'Client connections accepted')
+        lines.append(f'{p}_connections_total {self.connections}')
+        for name, (help, function) in self.gauges.items():
+            header(name, 'gauge', help)
+            lines.append(f'{p}_{name} {function()}')
+
+        byOpcode('packets_received_total', 'Packets decoded from clients', self.packetsIn)
+        header('bytes_received_total', 'counter', 'Bytes read from client connections')
+        lines.append(f'{p}_bytes_received_total {self.bytesIn}')
+        byOpcode('packets_sent_total', 'Packets queued for clients', self.packetsOut)
+        byOpcode('bytes_sent_total', 'Bytes of packets queued for clients', self.bytesOut)
+
+        header('decode_errors_total', 'counter', 'Client packets that could not be decoded')
+        for code, value in sorted(self.decodeErrors.items()):
+            lines.append(f'{p}_decode_errors_total{{error="{getErrCode(code)}"}} {value}')
+
+        histograms('processing_seconds', 'Time spent handling a client packet', self.processing)
+        histograms('fanout_size', 'Recipients of one message sent to many clients', self.fanout)
+        return '\n'.join(lines) + '\n'
+
+    def writeFile(self, path):
+        """
+        Replace the file at path with the current metrics,
+        readers never see a half written file
+        """
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as f:
+            f.write(self.render())
+        os.replace(temp, path)
+
+    def exportFile(self, path, interval=EXPORT_INTERVAL):
+        """
+        Write the metrics file every interval seconds on a new thread
+        """
+        def export():
+            while True:
+                self.writeFile(path)
+                time.sleep(interval)
+        start_new_thread(export, ())
+
+    def serveSocket(self, path):
+        """
+        Listen on a Unix socket at path, every connection is sent
+        the current metrics and closed. Runs on a new thread
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(16)
+
+        def serve():
+            while True:
+                conn, _ = listener.accept()
+                try:
+                    conn.sendall(self.render().encode())
+                except OSError:
+                    pass
+                conn.close()
+        start_new_thread(serve, ())
+
+
+def splitFrames(data):
+    """
+    Returns (OPCODE, SIZE) for every packet in data with
+    the frame flags removed
+    """
+    frames = []
+    offset = 0
+    end = len(data)
+    while offset < end:
+        opCode, length = HEADER_STRUCT.unpack_from(data, offset)
+        size = HEADER_SIZE + length
+        frames.append((opCode & OPCODE_MASK, size))
+        offset += size
+    return frames
@@ -0,0 +1,70 @@
+import heapq, threading
+
+class UsernameIndex:
+    """
+    The usernames in use on the server.
+
+    Membership is a set lookup. Each name that was asked for more than
+    once keeps the next "(i)" suffix to hand out and a heap of suffixes
+    freed by users who left, so a crowd asking for the same name never
+    scans the names already given out
+    """
+
+    def __init__(self):
+        self.names = set()
+        self.lock = threading.Lock()
+
+        # Suffixes of each wanted name, the next never used
+        # and the freed ones, smallest first
+        self.nextSuffix = {}
+        self.freed = {}
+
+        # (WANTED NAME, SUFFIX) of every suffixed name given out
+        self.suffixes = {}
+
+    def __contains__(self, username):
+        return username in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def claim(self, wantName):
+        """
+        Take wantName if it is free, otherwise the first free
+        "(i)" name from the freed suffixes or the next new one
+        """
+        with self.lock:
+            if wantName not in self.names:
+                self.names.add(wantName)
+                return wantName
+
+            freed = self.freed.get(wantName)
+            while freed:
+                i = heapq.heappop(freed)
+                username = wantName + f"({i})"
+                # Someone may have asked for the suffixed name itself
+                if username not in self.names:
+                    return self.take(wantName, i, username)
+
+            i = self.nextSuffix.get(wantName, 1)
+            username = wantName + f"({i})"
+            while username in self.names:
+                i += 1
+                username = wantName + f"({i})"
+            self.nextSuffix[wantName] = i + 1
+            return self.take(wantName, i, username)
+
+    def take(self, wantName, i, username):
+        self.names.add(username)
+        self.suffixes[username] = (wantName, i)
+        return username
+
+    def release(self, username):
+        """
+        Free a name, its suffix is handed out again
+        """
+        with self.lock:
+            self.names.discard(username)
+            if username in self.suffixes:
+                wantName, i = self.suffixes.pop(username)
+                heapq.heappush(self.freed.setdefault(wantName, []), i)
@@ -0,0 +1,253 @@
+import collections, os, socket, threading
+from packet import *
+from _thread import *
+
+"""
+Most packets handed to one sendmsg call
+"""
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+"""
+Number of packets that can wait to be written to one client
+before the overflow policy is applied
+"""
+OUTBOX_SIZE = 256
+
+"""
+Bytes that can wait to be written to one client, a few long messages
+fill the outbox long before OUTBOX_SIZE packets do
+"""
+OUTBOX_BYTES = 4 * 1024 * 1024
+
+"""
+Overflow policies for a full outbox
+
+DROP_OLDEST - drop the oldest queued chat message to make room
+DISCONNECT  - drop the slow client
+BLOCK       - make the sender wait until there is room, a sender
+              that cannot wait drops the client as DISCONNECT does
+"""
+DROP_OLDEST = 'drop_oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+class Outbox:
+    """
+    Bounded queue of packets waiting to be written to one client.
+
+    The outbox is full at maxSize packets or maxBytes bytes, an empty
+    outbox still takes one packet larger than maxBytes. Keeps the
+    queue depth, the deepest it has been and how many packets were
+    dropped so slow clients can be found.
+    """
+
+    def __init__(self, maxSize=OUTBOX_SIZE, policy=DROP_OLDEST, maxBytes=OUTBOX_BYTES):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown outbox policy "{policy}"')
+        self.maxSize = maxSize
+        self.maxBytes = maxBytes
+        self.policy = policy
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.ready = threading.Condition()
+        self.closed = False
+
+        # Counters
+        self.dropped = 0
+        self.highWater = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, packet, block=True):
+        """
+        Queue a packet for the client.
+
+        Returns False when the client should be disconnected,
+        either by the DISCONNECT policy or because the outbox is closed.
+        When block is False the BLOCK policy cannot wait for room
+        and disconnects instead, the outbox never grows past maxSize
+        """
+        with self.ready:
+            if self.closed:
+                return False
+
+            if self.full(packet):
+                if self.policy == DISCONNECT or (self.policy == BLOCK and not block):
+                    self.dropped += 1
+                    return False
+                elif self.policy == BLOCK:
+                    while self.full(packet) and not self.closed:
+                        self.ready.wait()
+                    if self.closed:
+                        return False
+                elif self.policy == DROP_OLDEST:
+                    while self.full(packet):
+                        if not self.dropChat(packet):
+                            return True
+
+            self.frames.append(packet)
+            self.bytes += len(packet)
+            if len(self.frames) > self.highWater:
+                self.highWater = len(self.frames)
+            self.ready.notify_all()
+            return True
+
+    def full(self, packet):
+        """
+        True if there is no room for the packet
+        """
+        frames = self.frames
+        return bool(frames) and (len(frames) >= self.maxSize or self.bytes + len(packet) > self.maxBytes)
+
+    def dropChat(self, packet):
+        """
+        Make room by dropping the oldest queued chat message,
+        control packets are only dropped when nothing else can be.
+
+        Returns False when the new packet is the one dropped
+        """
+        self.dropped += 1
+        for i, queued in enumerate(self.frames):
+            if isChat(queued):
+                del self.frames[i]
+                self.bytes -= len(queued)
+                return True
+        if isChat(packet):
+            return False
+        self.bytes -= len(self.frames.popleft())
+        return True
+
+    def take(self, block=True):
+        """
+        Remove and return every queued packet as a list.
+
+        Waits for a packet when block is set, returns None once
+        the outbox is closed and empty
+        """
+        with self.ready:
+            while block and not self.frames and not self.closed:
+                self.ready.wait()
+            if not self.frames:
+                return None if self.closed else []
+            frames = list(self.frames)
+            self.frames.clear()
+            self.bytes = 0
+            self.ready.notify_all()
+            return frames
+
+    def close(self):
+        """
+        Stop accepting packets and wake anyone waiting on the outbox
+        """
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+
+def isChat(packet):
+    """
+    True if the packet is a chat message that can be dropped,
+    the flags of compressed or fragmented messages are ignored
+    """
+    return HEADER_STRUCT.unpack_from(packet)[0] & OPCODE_MASK == OPCODES["OPCODE_BROADCAST_MSG"]
+
+
+class QueuedSocket:
+    """
+    Wraps a client socket for the threaded server.
+
+    send queues the packet and returns at once, a writer thread owned
+    by the connection drains the queue so one slow reader never holds
+    up the thread sending to it. Everything queued is written together
+    so a burst of packets costs one system call.
+    """
+
+    def __init__(self, sock, outbox, metrics=None):
+        self.sock = sock
+        self.outbox = outbox
+        # Counts the packets queued, optional
+        self.metrics = metrics
+        # Number of writes made to the socket
+        self.writes = 0
+        # Compression mode chosen in the HELLO handshake
+        self.compress = None
+        # Cache the address, it cannot be read once the socket closes
+        self.peername = sock.getpeername()
+        # The client's Session, set by the server
+        self.session = None
+        start_new_thread(self.writer,())
+
+    def send(self, data):
+        if not self.outbox.put(data):
+            self.shutdown()
+        elif self.metrics:
+            self.metrics.sent(data)
+        return len(data)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def getpeername(self):
+        return self.peername
+
+    def writer(self):
+        """
+        Writes queued packets to the socket until the outbox closes.
+        If the client cannot be written to its connection is shut down
+        so the client thread removes it.
+        """
+        while True:
+            frames = self.outbox.take()
+            if frames is None:
+                return
+            try:
+                self.sendFrames(frames)
+            except OSError:
+                self.shutdown()
+                return
+
+    def sendFrames(self, frames):
+        """
+        Write a list of packets with as few calls as possible.
+        sendmsg gathers them without joining, a partial write
+        continues from the first byte that was not sent
+        """
+        if not hasattr(self.sock, 'sendmsg'):
+            self.writes += 1
+            self.sock.sendall(b''.join(frames))
+            return
+
+        while frames:
+            batch = frames[:IOV_MAX]
+            sent = self.sock.sendmsg(batch)
+            self.writes += 1
+
+            # Skip the packets that were fully written
+            done = 0
+            for packet in batch:
+                if sent < len(packet):
+                    break
+                sent -= len(packet)
+                done += 1
+            frames = frames[done:]
+            if sent:
+                frames[0] = memoryview(frames[0])[sent:]
+
+    def shutdown(self):
+        """
+        Stop all traffic, the client thread sees the connection end
+        """
+        self.outbox.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        self.shutdown()
+        self.sock.close()
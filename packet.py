@@ -1,4 +1,4 @@
-import struct
+import struct, zlib
 
 """
 Sets the max packet size for transmission,
@@ -15,10 +15,19 @@ Current format is OPCODE - ushort (H), Payload Length - uint (I)
 """
 HEADER_FMT = '=HI'
 HEADER_SIZE = struct.calcsize(HEADER_FMT)
+HEADER_STRUCT = struct.Struct(HEADER_FMT)
+
+"""
+Payloads larger than one packet are split into fragments. Every
+fragment but the last sets FLAG_MORE, and the receiver joins them
+back together, up to MAX_MESSAGE_SIZE bytes per message
+"""
+MAX_PAYLOAD_SIZE = MAX_PACKET_SIZE - HEADER_SIZE
+MAX_MESSAGE_SIZE = 1024 * 1024
 
 """
 Opcode dictionary, codes are packed as unsigned shorts 2 bytes in size
-up to 256 possible opcodes
+up to 256 possible opcodes. The high byte holds the frame flags
 """
 OPCODES = {
     "OPCODE_ERR": 0,
@@ -31,13 +40,68 @@ OPCODES = {
     "OPCODE_LEAVE_ROOM": 7,
     "OPCODE_SEND_MSG": 8,
     "OPCODE_BROADCAST_MSG": 9,
+    "OPCODE_USER_JOINED": 10,
+    "OPCODE_USER_LEFT": 11,
+    "OPCODE_STATS": 12,
+    "OPCODE_PEER_ROOM": 13,
+    "OPCODE_PEER_JOIN": 14,
+    "OPCODE_PEER_LEAVE": 15,
+    "OPCODE_PEER_BROADCAST": 16,
+    "OPCODE_PEER_LINK": 17,
+    "OPCODE_HISTORY": 18,
+    "OPCODE_FETCH_HISTORY": 19,
+    "OPCODE_PING": 20,
+    "OPCODE_PONG": 21,
 }
 
+OPCODE_MASK = 0x00FF
+FLAG_MORE = 0x8000
+FLAG_COMPRESSED = 0x4000
+
+"""
+Compression negotiated in OPCODE_HELLO. The server offers its modes
+after the welcome text and the client picks one after its username,
+each on a new line.
+
+Every payload is compressed on its own so one compressed broadcast can
+be sent to every recipient. The shared dictionary holds text common to
+most payloads so even short messages shrink. Payloads under the
+threshold are not worth the CPU and are sent as they are
+"""
+COMPRESS_ZLIB = 'zlib'
+COMPRESSION_MODES = (COMPRESS_ZLIB,)
+COMPRESS_THRESHOLD = 128
+COMPRESS_LEVEL = 6
+
+"""
+A small window and memory level make setting up the compressor for
+each payload cheap, payloads are rarely larger than the window
+"""
+COMPRESS_WBITS = 12
+COMPRESS_MEMLEVEL = 5
+COMPRESS_DICT = (
+    b'ERR_UNKNOWN ERR_ILLEGAL_OPCODE ERR_ILLEGAL_LENGTH ERR_ILLEGAL_MESSAGE '
+    b'ERR_TOO_MANY_USERS ERR_TOO_MANY_ROOMS ERR_NOT_IN_ROOM ERR_ILLEGAL_NAME '
+    b'ERR_NAME_EXISTS - your username is now room name already exists '
+    b'there is no chatroom named you are not in a room Welcome to the Server '
+    b' the and that have for not with you this but his from they say her she '
+    b'will one all would there their what so up out if about who get which go '
+    b'me when make can like time no just him know take people into year your '
+    b'good some could them see other than then now look only come its over '
+    b'think also back after use two how our work first well way even new want '
+    b'because any these give day most us is are was were has had do does did '
+    b'lol ok yes hey hi hello thanks ,room1,room2,room3,room4,user,guest,> <'
+)
+
+"""
+Reverse lookup table and set of valid opcodes, so checking
+or naming an opcode does not search the dictionary
+"""
+OPCODE_NAMES = {v: k for k, v in OPCODES.items()}
+VALID_OPCODES = frozenset(OPCODES.values())
+
 def getOpCode(num):
-    for k,v in OPCODES.items():
-        if num == v:
-            return k
-    return "OPCODE_UNKNOWN"
+    return OPCODE_NAMES.get(num, "OPCODE_UNKNOWN")
 
 """
 Error code dictionary, codes are packed as unsigned shorts 2 bytes in size
@@ -45,6 +109,7 @@ up to 256 possible error codes
 """
 ERROR_FMT = 'H'
 ERROR_SIZE = struct.calcsize(ERROR_FMT)
+ERROR_STRUCT = struct.Struct(ERROR_FMT)
 ERRORCODES = {
     "ERR_UNKNOWN": 0,
     "ERR_ILLEGAL_OPCODE": 1,
@@ -57,37 +122,122 @@ ERRORCODES = {
     "ERR_NOT_IN_ROOM": 9
 }
 
+ERROR_NAMES = {v: k for k, v in ERRORCODES.items()}
+VALID_ERRORS = frozenset(ERRORCODES.values())
+
 def getErrCode(num):
-    for k,v in ERRORCODES.items():
-        if num == v:
-            return k
-    return "ERR_UNKNOWN"
+    return ERROR_NAMES.get(num, "ERR_UNKNOWN")
 
-def encodePacket(opCode, payload='0'):
+def encodePacket(opCode, payload='0', compress=None):
     """
     Message struct contains the Header struct and
     the payload as a binary
+
+    A payload too large for one packet is returned as
+    several fragment packets joined together. compress is the
+    negotiated compression mode, if any
+
+    Raises ValueError when the packet cannot be encoded
     """
-    # If OPCODE is invalid return an error
-    if opCode not in OPCODES.values():
-        return 'ERROR ENCODING PACKET - Illegal OPCODE provided'
+    if opCode not in VALID_OPCODES:
+        raise ValueError('Illegal OPCODE provided')
 
-    # Encode message and get its length
+    # Encode message, the receiver limits the size once decompressed
     msg_bin = encodePayload(payload)
-    msg_size = len(msg_bin)
+    if len(msg_bin) > MAX_MESSAGE_SIZE:
+        raise ValueError('Payload exceeds Max Message Size')
+    if compress:
+        opCode, msg_bin = compressPayload(opCode, msg_bin, compress)
+    return packFrames(opCode, msg_bin)
+
+def compressPayload(opCode, msg_bin, compress):
+    """
+    Compress a payload above the threshold, returns the opcode
+    with FLAG_COMPRESSED set and the compressed payload. Payloads
+    that do not get smaller are returned unchanged
+    """
+    if len(msg_bin) < COMPRESS_THRESHOLD or compress not in COMPRESSION_MODES:
+        return opCode, msg_bin
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_WBITS, COMPRESS_MEMLEVEL, zdict=COMPRESS_DICT)
+    packed = compressor.compress(msg_bin) + compressor.flush()
+    if len(packed) >= len(msg_bin):
+        return opCode, msg_bin
+    return opCode | FLAG_COMPRESSED, packed
+
+def decompressPayload(msg_bin, maxSize=MAX_MESSAGE_SIZE):
+    """
+    Undo compressPayload. Returns None when the data is invalid
+    or would inflate past maxSize
+    """
+    decompressor = zlib.decompressobj(COMPRESS_WBITS, zdict=COMPRESS_DICT)
+    try:
+        plain = decompressor.decompress(msg_bin, maxSize)
+    except zlib.error:
+        return None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None
+    return plain
+
+def encodePacketInto(buffer, offset, opCode, payload='0'):
+    """
+    Writes the packet into a bytearray the caller already owns at
+    offset, the buffer grows if the packet runs past its end.
+    This saves nothing over encodePacket unless the packet would
+    be copied into such a buffer anyway.
 
-    # If payload exceeds packet size return an error
-    if (msg_size + HEADER_SIZE) > MAX_PACKET_SIZE:
-        return 'ERROR ENCODING PACKET - Payload excees Max Packet Size'
+    Returns the offset just past the packet, raises ValueError
+    when the packet cannot be encoded
+    """
+    if opCode not in VALID_OPCODES:
+        raise ValueError('Illegal OPCODE provided')
 
-    # Encode Header
-    header = encodeHeader(opCode,msg_size)
+    msg_bin = encodePayload(payload)
+    if len(msg_bin) > MAX_MESSAGE_SIZE:
+        raise ValueError('Payload exceeds Max Message Size')
 
-    # Dynamically get struct format from paylaod size
-    msg_fmt = f'{HEADER_SIZE}s{msg_size}s'
+    packet = packFrames(opCode, msg_bin)
+    end = offset + len(packet)
+    buffer[offset:end] = packet
+    return end
 
-    # Return fully encoded packet
-    return struct.pack(msg_fmt, header, msg_bin)
+def encodePackets(messages, compress=None):
+    """
+    Encodes a list of (OPCODE, PAYLOAD) messages back to back
+    into one buffer so they can be written with a single send
+
+    Raises ValueError when any message cannot be encoded
+    """
+    packets = []
+    for opCode, payload in messages:
+        if opCode not in VALID_OPCODES:
+            raise ValueError('Illegal OPCODE provided')
+        msg_bin = encodePayload(payload)
+        if len(msg_bin) > MAX_MESSAGE_SIZE:
+            raise ValueError('Payload exceeds Max Message Size')
+        if compress:
+            opCode, msg_bin = compressPayload(opCode, msg_bin, compress)
+        packets.append(packFrames(opCode, msg_bin))
+
+    # Joining bytes objects is one copy, cheaper than
+    # packing each one into a preallocated buffer
+    return b''.join(packets)
+
+def packFrames(opCode, msg_bin):
+    """
+    The payload as one packet, or as fragment packets joined
+    together when it does not fit in one
+    """
+    msg_size = len(msg_bin)
+    if msg_size + HEADER_SIZE <= MAX_PACKET_SIZE:
+        return HEADER_STRUCT.pack(opCode, msg_size) + msg_bin
+
+    frames = []
+    for start in range(0, msg_size, MAX_PAYLOAD_SIZE):
+        chunk = msg_bin[start:start + MAX_PAYLOAD_SIZE]
+        last = start + MAX_PAYLOAD_SIZE >= msg_size
+        frames.append(HEADER_STRUCT.pack(opCode if last else opCode | FLAG_MORE, len(chunk)))
+        frames.append(chunk)
+    return b''.join(frames)
 
 def encodeHeader(opCode, length):
     """
@@ -97,20 +247,22 @@ def encodeHeader(opCode, length):
     Returns a binary of length HEADER_FMT with the opCode
     and payload length
     """
-    return struct.pack(HEADER_FMT, opCode, length)
+    return HEADER_STRUCT.pack(opCode, length)
 
 def encodePayload(payload):
     """
     Converts the payload binary string and returns it
-    Assumes payload is a string or an error number
+    Assumes payload is a string, an error number or already binary
     """
 
     # Checks if the payload is either a string or a number
     # Strings are messages, numbers are Error codes
     if type(payload) == str:
         return payload.encode()
+    elif type(payload) in (bytes, bytearray):
+        return payload
     else:
-        return struct.pack(ERROR_FMT,payload)
+        return ERROR_STRUCT.pack(payload)
 
 
 def encodeError(code):
@@ -122,37 +274,47 @@ def encodeError(code):
     """
 
     # Invalid codes will create an 'unknown' code
-    errCode = code
-    if code not in ERRORCODES.values():
-        errCode = ERRORCODES["ERR_UNKNOWN"]
-
-    # Construct the packet
-    header = encodeHeader(OPCODES["OPCODE_ERR"],ERROR_SIZE)
-    errorFormat = f'{HEADER_SIZE}s{ERROR_FMT}'
+    if code not in VALID_ERRORS:
+        code = ERRORCODES["ERR_UNKNOWN"]
 
-    return struct.pack(errorFormat, header, errCode)
+    return ERROR_PACKETS[code]
 
 def decodePacket(packet):    
     """
     Splits a packet into the opcode, payload length and 
     payload decodes them and returns them as a tuple
     (OPCODE, LENGTH, PAYLOAD)
+
+    The packet can be bytes, a bytearray or a memoryview. A
+    memoryview's payload is decoded without copying it out, which
+    is slower than decoding bytes for packets of this size
     """
  
-    # Decode the header and payload
-    header, bin_pyld = struct.unpack(f'{HEADER_SIZE}s{len(packet)-HEADER_SIZE}s',packet)
-    opCode, length = decodeHeader(header)
+    # Decode the header
+    opCode, length = HEADER_STRUCT.unpack_from(packet)
 
-    # Verify OPCODE is valid
-    if opCode not in OPCODES.values():
-        return encodePacket(OPCODES["OPCODE_ERR"], ERRORCODES["ERR_ILLEGAL_OPCODE"])
+    # Verify OPCODE is valid, a compressed packet is
+    # the only flag allowed outside of a FrameDecoder
+    compressed = opCode & FLAG_COMPRESSED
+    opCode &= ~FLAG_COMPRESSED
+    if opCode not in VALID_OPCODES:
+        return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_OPCODE"]]
 
     # Verify the length of the payload is valid
-    if length != len(bin_pyld):
-        return encodePacket(OPCODES["OPCODE_ERR"], ERRORCODES["ERR_ILLEGAL_LENGTH"])
+    if length != len(packet) - HEADER_SIZE:
+        return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_LENGTH"]]
 
     # Decode the payload
-    payload = decodePayload(opCode,bin_pyld)
+    msg_bin = packet[HEADER_SIZE:]
+    if compressed:
+        msg_bin = decompressPayload(msg_bin)
+        if msg_bin is None:
+            return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_MESSAGE"]]
+        length = len(msg_bin)
+    try:
+        payload = decodePayload(opCode, msg_bin)
+    except UnicodeDecodeError:
+        return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_MESSAGE"]]
 
     return (opCode, length, payload)
 
@@ -161,7 +323,7 @@ def decodeHeader(header):
     Converts the header from the binary string into
     a tuple of (ODCODE, PAYLOAD LENGTH)
     """
-    return struct.unpack(HEADER_FMT, header)
+    return HEADER_STRUCT.unpack(header)
    
 
 
@@ -172,8 +334,140 @@ def decodePayload(opCode, payload):
     """
 
     if opCode == OPCODES["OPCODE_ERR"] and len(payload) == ERROR_SIZE:
-        erCode = struct.unpack(ERROR_FMT,payload)
-        return erCode[0] # Return the Error Code
+        return ERROR_STRUCT.unpack_from(payload)[0] # Return the Error Code
+    elif type(payload) == memoryview:
+        return str(payload, 'utf-8')
     else:
         return payload.decode()
 
+"""
+Every error packet is constant so they are built once
+"""
+ERROR_PACKETS = {code: encodePacket(OPCODES["OPCODE_ERR"], code) for code in VALID_ERRORS}
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for the packets arriving on one connection.
+
+    TCP can merge several packets into one read or split one packet
+    across reads. Bytes are buffered until the length field of the
+    header says a whole packet has arrived, anything left over is
+    kept for the next read.
+
+    Fragments are joined back into one message, a message larger
+    than maxMessage is dropped with an ERR_ILLEGAL_LENGTH error.
+    Compressed messages are inflated once all their fragments arrive
+
+    A header with an impossible length leaves no way to find the next
+    packet, failed is set and the connection should be closed
+    """
+
+    def __init__(self, maxMessage=MAX_MESSAGE_SIZE):
+        self.buffer = bytearray()
+        self.maxMessage = maxMessage
+
+        # Payload of the fragmented message being joined, the opcode
+        # keeps its FLAG_COMPRESSED flag
+        self.fragments = bytearray()
+        self.fragmentOp = None
+        self.discarding = False
+        self.failed = False
+
+    def feed(self, data):
+        """
+        Add bytes read from the socket and yield every complete packet
+        as decodePacket would return it, (OPCODE, LENGTH, PAYLOAD) or
+        an encoded error packet
+        """
+        if self.failed:
+            return
+        buffer = self.buffer
+        buffer += data
+        start = 0
+        try:
+            while len(buffer) - start >= HEADER_SIZE:
+                opCode, length = HEADER_STRUCT.unpack_from(buffer, start)
+
+                # A length this large cannot be trusted so the rest of
+                # the stream cannot be split, stop decoding it
+                if HEADER_SIZE + length > MAX_PACKET_SIZE:
+                    start = len(buffer)
+                    self.failed = True
+                    yield ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_LENGTH"]]
+                    break
+
+                end = start + HEADER_SIZE + length
+                if end > len(buffer):
+                    break
+
+                # Copying a packet out of the buffer and decoding it is
+                # faster than decoding from a memoryview of the buffer
+                payload = buffer[start + HEADER_SIZE:end]
+                if opCode in VALID_OPCODES and self.fragmentOp is None:
+                    decodedPkt = self.decodeMessage(opCode, payload)
+                else:
+                    decodedPkt = self.joinFragment(opCode, payload)
+                start = end
+                if decodedPkt is not None:
+                    yield decodedPkt
+        finally:
+            # Only keep the bytes of the unfinished packet
+            del buffer[:start]
+
+    def joinFragment(self, opCode, payload):
+        """
+        Add a fragment, or a packet with flags, to the message being
+        joined. Returns the decoded message once its last fragment
+        arrives, an error packet when the fragments are invalid,
+        otherwise None
+        """
+        more = opCode & FLAG_MORE
+        baseOp = opCode & ~FLAG_MORE
+        if (baseOp & ~FLAG_COMPRESSED) not in VALID_OPCODES or (self.fragmentOp not in (None, baseOp)):
+            self.resetFragments()
+            return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_OPCODE"]]
+
+        if not self.discarding:
+            if len(self.fragments) + len(payload) > self.maxMessage:
+                # Too large, skip the rest of this message
+                self.fragments = bytearray()
+                self.discarding = True
+                if more:
+                    self.fragmentOp = baseOp
+                else:
+                    self.resetFragments()
+                return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_LENGTH"]]
+            self.fragments += payload
+
+        if more:
+            self.fragmentOp = baseOp
+            return None
+
+        discarded = self.discarding
+        msg_bin = bytes(self.fragments)
+        self.resetFragments()
+        if discarded:
+            return None
+
+        if baseOp & FLAG_COMPRESSED:
+            baseOp &= ~FLAG_COMPRESSED
+            msg_bin = decompressPayload(msg_bin, self.maxMessage)
+            if msg_bin is None:
+                return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_MESSAGE"]]
+        return self.decodeMessage(baseOp, msg_bin)
+
+    def decodeMessage(self, opCode, msg_bin):
+        """
+        (OPCODE, LENGTH, PAYLOAD), an error packet
+        when the text is not valid UTF-8
+        """
+        try:
+            return (opCode, len(msg_bin), decodePayload(opCode, msg_bin))
+        except UnicodeDecodeError:
+            return ERROR_PACKETS[ERRORCODES["ERR_ILLEGAL_MESSAGE"]]
+
+    def resetFragments(self):
+        self.fragments = bytearray()
+        self.fragmentOp = None
+        self.discarding = False
@@ -1,34 +1,144 @@
 import builtins
-import socket, time
+import asyncio, collections, socket, time
 import tkinter as tk
 from types import CellType
 from packet import *
+from outbox import *
+from metrics import *
+from dispatch import *
+from history import *
+from snapshot import *
+from names import *
+from session import *
+from lifecycle import *
 from _thread import *
+
+"""
+Listen backlog used by the asyncio engine, large enough that a burst
+of reconnecting clients is not refused while the loop catches up
+"""
+ASYNC_BACKLOG = 1024
+
+"""
+Most times per second the room and user panels are redrawn
+"""
+INFO_RATE = 5
+
+"""
+Longest room name in bytes, rooms are listed to every client
+and kept in the snapshot
+"""
+MAX_ROOM_NAME = 256
+
+"""
+Largest chat message with the sender's name, room name included.
+The rest of a message is kept for the history number and time and
+the IDs added when it is passed to other workers or nodes
+"""
+MAX_CHAT_SIZE = MAX_MESSAGE_SIZE - 256
     
 class Server:
-    def __init__(self,netInfo ,textBox, roomText, userText):
+    def __init__(self,netInfo ,textBox, roomText, userText, eventQueue=None, outboxSize=OUTBOX_SIZE, outboxPolicy=DROP_OLDEST, outboxBytes=OUTBOX_BYTES,
+                 reusePort=False, bus=None, historyDir=None, historyReplay=HISTORY_REPLAY, snapshotPath=None,
+                 heartbeat=HEARTBEAT_INTERVAL, idleTimeout=IDLE_TIMEOUT, nodeName=None):
         self.netInfo = netInfo
 
+        # Outbound queue settings for every client
+        self.outboxSize = outboxSize
+        self.outboxBytes = outboxBytes
+        self.outboxPolicy = outboxPolicy
+
         # GUI interfaces
         self.textBox = textBox
         self.roomText = roomText
         self.userText = userText
 
+        # Widgets are only changed by the GUI thread, network threads
+        # post their events to this queue. Without a queue the widgets
+        # are written directly
+        self.eventQueue = eventQueue
+
         # Create server
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Worker processes of a cluster all accept on the same port
+        if reusePort:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server.bind(self.netInfo)
         # Max allowable connections
         self.server.listen(100)
 
-        self.lastPacket = {}
-
-        # Client and room data
+        # Client and room data, each client's username and room
+        # are kept in its Session (client.session)
         self.clientList = []
-        self.usernames = {}
-        self.userRoom = {}
+        self.nameIndex = UsernameIndex()
         self.roomList = ['room1','room2','room3','room4']
 
+        # Rooms and history cursors are restored from the last snapshot
+        # and saved to it in the background while running
+        self.snapshotPath = snapshotPath
+        self.snapshots = None
+        cursors = {}
+        if snapshotPath:
+            rooms = loadSnapshot(snapshotPath)
+            if rooms:
+                self.roomList = [room for room, cursor in rooms]
+                cursors = dict(rooms)
+            self.snapshots = SnapshotWriter(snapshotPath, self.snapshotRooms, failed=self.snapshotFailed)
+
+        # Members of each room, dicts are used as ordered sets
+        # so fan-out only touches the clients in the room
+        self.roomMembers = {room: {} for room in self.roomList}
+
+        # Link to the other workers of a cluster, None when running alone.
+        # Names are only unique on one worker, the others see them as
+        # "username@nodeName". The usernames in each room on other
+        # workers, {username: count}
+        self.bus = bus
+        self.nodeName = nodeName
+        self.remoteMembers = {room: {} for room in self.roomList}
+
+        # Messages sent in each room, replayed to users who join.
+        # With a directory every message is also kept on disk
+        self.historyDir = historyDir
+        self.historyReplay = historyReplay
+        self.history = {room: RoomHistory(room, historyDir, count=cursors.get(room, 0)) for room in self.roomList}
+
+        # Changes to the room and user panels waiting to be drawn,
+        # ('rooms' or 'users', True when added, name)
+        self.infoChanges = collections.deque(('rooms', True, room) for room in self.roomList)
+        self.infoRows = {'rooms': [], 'users': []}
+        self.infoPending = False
+        self.infoRate = INFO_RATE
+        self.lastInfo = 0
+
+        # Silent clients are pinged and dead ones closed
+        self.lifecycle = Lifecycle(self.ping, self.reapClient, heartbeat, idleTimeout)
+
+        # Counters and histograms, sent for OPCODE_STATS
+        self.metrics = Metrics()
+        self.metrics.gauge('connections_open', 'Clients connected', lambda: len(self.clientList))
+        self.metrics.gauge('users', 'Clients with a username', lambda: len(self.nameIndex))
+        self.metrics.gauge('rooms', 'Rooms on the server', lambda: len(self.roomMembers))
+        self.metrics.gauge('outbox_queued', 'Packets waiting in client outboxes',
+                           lambda: sum(len(client.outbox) for client in list(self.clientList)))
+        self.metrics.gauge('outbox_queued_bytes', 'Bytes waiting in client outboxes',
+                           lambda: sum(client.outbox.bytes for client in list(self.clientList)))
+        self.metrics.gauge('connections_reaped', 'Connections closed for being silent too long',
+                           lambda: self.lifecycle.reaped)
+        self.metrics.gauge('outbox_dropped', 'Packets dropped from the outboxes of connected clients',
+                           lambda: sum(client.outbox.dropped for client in list(self.clientList)))
+
+        # Packets are routed by opcode, handler run times
+        # are recorded by an after hook
+        self.dispatcher = Dispatcher(self.ignore)
+        self.registerHandlers()
+        self.dispatcher.after(lambda opCode, args, result, seconds: self.metrics.processed(opCode, seconds))
+
+        # Packets from the other workers of a cluster
+        self.peerDispatcher = Dispatcher(lambda payload: None)
+        self.registerPeerHandlers()
+
         self.running = True
     
     def clientThread(self,client):
@@ -41,56 +151,111 @@ class Server:
         """
         
         # Connection establised send the client the hellow message
-        hello = encodePacket(OPCODES["OPCODE_HELLO"],'Welcome to the Server') 
-        client.send(hello)
+        client.send(self.helloPacket())
     
-        while True:
+        session = client.session
+        decoder = FrameDecoder()
+        try:
+            while True:
                 try:
-                    # Grab the packet from the client
-                    packet = client.recv(MAX_PACKET_SIZE)
-                except:
-                    continue
-                else:
-                    if packet:
-                        # Decode the packet
-                        decodedPkt = decodePacket(packet)
-                        
-                        # Decode returned an error print the error for
-                        # the server and sent it back to the client
-                        if type(decodedPkt) == bytes:
-                            opCode, length, errCode = decodePacket(decodedPkt)
-                            event = self.buildTag(client) + " ERROR in client packet - " + getErrCode(errCode)
-                            self.printEvent(event,True)
-                            client.send(decodedPkt)
-
-                        else:
-                            self.processMessage(client, decodedPkt)
-
-                    # Something is wrong with the packet close the connection
-                    else:
-                        self.remove(client)
-    
+                    # Grab the bytes sent by the client
+                    data = client.recv(MAX_PACKET_SIZE)
+                # The connection failed or was closed by the server
+                except OSError:
+                    data = b''
+
+                # Client disconnected close the connection
+                if not data:
+                    return
+
+                # A read can hold several packets or only part of one
+                session.lastSeen = time.monotonic()
+                self.metrics.read(len(data))
+                for decodedPkt in decoder.feed(data):
+                    self.handlePacket(client, decodedPkt)
+
+                # The packets can no longer be told apart
+                if decoder.failed:
+                    return
+        finally:
+            # However the thread ends the connection is released
+            self.closeClient(client)
+
+    def helloPacket(self):
+        """
+        The welcome message, followed by the compression
+        modes the client can choose from
+        """
+        return encodePacket(OPCODES["OPCODE_HELLO"],'Welcome to the Server\n' + ','.join(COMPRESSION_MODES))
+
+    def handlePacket(self, client, decodedPkt):
+        """
+        Process a packet decoded from a client.
+        Shared by every server engine so they all behave the same.
+        """
+        # Decode returned an error print the error for
+        # the server and sent it back to the client
+        if type(decodedPkt) == bytes:
+            opCode, length, errCode = decodePacket(decodedPkt)
+            self.metrics.decodeError(errCode)
+            event = client.session.tag + " ERROR in client packet - " + getErrCode(errCode)
+            self.printEvent(event,True)
+            client.send(decodedPkt)
+
+        else:
+            opCode, length, payload = decodedPkt
+            self.metrics.received(opCode)
+            self.processMessage(client, decodedPkt)
                 
         
     def remove(self, client):
         """
         Remove a client from the following:
         self.clientList
-        self.usernames
-        self.userRoom
-        
+        self.roomMembers
+        self.nameIndex
+
+        A client may be removed more than once, its
+        name is only given up the first time
         """
-        clientIp = client.getpeername()
+        session = client.session
 
         if client in self.clientList:
             self.clientList.remove(client)
         
-        if client in self.userRoom:
-            self.userRoom.pop(client)
+        self.dropMember(client)
 
-        if clientIp in self.usernames:
-            self.usernames.pop(clientIp)
+        if session.username is not None:
+            self.nameIndex.release(session.username)
+            self.infoChanges.append(('users', False, session.username))
+            session.rename(None)
 
+    def closeClient(self, client):
+        """
+        Release everything a dead connection holds, its room,
+        username and socket. Only the first call does anything,
+        the client's thread or protocol then sees the connection end
+        """
+        session = client.session
+        if session.closed:
+            return
+        session.closed = True
+        self.remove(client)
+        client.close()
+
+    def ping(self, client):
+        """
+        Client has been silent, ask it to answer
+        """
+        client.send(encodePacket(OPCODES["OPCODE_PING"],))
+
+    def reapClient(self, client):
+        """
+        Client stopped answering, close its connection
+        """
+        self.printEvent(client.session.tag + " timed out, connection closed", True)
+        self.closeClient(client)
+        self.updateInfo()
         
     
     def runServer(self):
@@ -102,17 +267,29 @@ class Server:
         """
         event = "Server running on " + self.netInfo[0] + ":" + str(self.netInfo[1])
         self.printEvent(event)
+        self.updateInfo()
+        if self.bus:
+            self.bus.start(self.busReceived)
+        if self.snapshots:
+            self.snapshots.start()
+        if self.lifecycle.enabled:
+            start_new_thread(self.lifecycle.run, ())
 
         while self.running:
             
-            # Accept new client connection
+            # Accept new client connection, packets sent to it
+            # are queued and written by its own writer thread
             client, clientIp = self.server.accept()
+            client = QueuedSocket(client, Outbox(self.outboxSize, self.outboxPolicy, self.outboxBytes), self.metrics)
+            client.session = Session(clientIp[:2])
+            self.lifecycle.watch(client)
+            self.metrics.connected()
         
             # Add client to the client list
             self.clientList.append(client)
         
             # prints the address of the user that just connected
-            event = self.buildTag(client) + " connected"
+            event = client.session.tag + " connected"
             self.printEvent(event)
         
             # creates and individual thread for every user
@@ -122,6 +299,25 @@ class Server:
         client.close()
         self.server.close()
 
+    def snapshotRooms(self):
+        """
+        Rooms and their history cursors for the snapshot writer,
+        read from copies so clients are never held up
+        """
+        history = self.history
+        return [(room, history[room].count) for room in list(self.roomList) if room in history]
+
+    def saveSnapshot(self):
+        """
+        Save the rooms now, called when the server shuts down
+        """
+        if self.snapshots:
+            self.snapshots.stop()
+
+    def snapshotFailed(self, error):
+        # Called on the writer thread, the next snapshot is tried as usual
+        self.printEvent("Snapshot not saved - " + str(error), True)
+
     def printEvent(self, event, error=False):
         """
         Print events to the server window at the time the event occurs.
@@ -133,105 +329,214 @@ class Server:
         else:
             config = 'normal' 
         currTime = time.strftime("%H:%M:%S",time.localtime())
+        line = currTime + " - " + event + "\n"
+
+        # The GUI thread inserts queued lines in batches
+        if self.eventQueue is not None:
+            self.eventQueue.put((self.textBox, line, config))
+            return
+
         self.textBox.configure(state='normal')
-        self.textBox.insert("end",currTime + " - " + event + "\n", f'{config}')
+        self.textBox.insert("end",line, f'{config}')
         self.textBox.tag_config('normal', foreground='black')
         self.textBox.tag_config('error', foreground='red')        
         self.textBox.see("end")
         self.textBox.configure(state='disabled')
 
-    def buildTag(self, client):
+    def runOnGui(self, function):
         """
-        Build the tag for printing events. Always contains IP:PORT
-        appends Username if present.
-        
-        <ClientIP:PORT - Username>
+        Run a function that changes widgets on the GUI thread
         """
-        clientIp = client.getpeername()
-        tag = "<" + clientIp[0] + ":" + str(clientIp[1])
-
-        if clientIp in self.usernames:
-            tag += " - " + self.usernames[clientIp] + ">"
+        if self.eventQueue is not None:
+            self.eventQueue.put(function)
         else:
-            tag += ">"
-
-        return tag
+            function()
 
     def updateInfo(self):
-        # Clear old info
+        """
+        Have the room and user panels show the changes made since
+        they were last drawn. Nothing is drawn when nothing changed
+        and updates are coalesced to at most infoRate per second
+        """
+        if not self.infoChanges or self.infoPending:
+            return
+        if self.eventQueue is None:
+            self.showInfo()
+            return
+        self.infoPending = True
+        self.eventQueue.put(self.flushInfo)
 
-        self.roomText.configure(state='normal')
-        self.roomText.delete(1.0,tk.END)
-        for room in self.roomList:
-            self.roomText.insert(tk.INSERT,room + '\n')
-        self.roomText.configure(state='disabled')
+    def flushInfo(self):
+        """
+        Runs on the GUI thread, waits out the rest of the
+        update interval before drawing
+        """
+        wait = self.lastInfo + 1 / self.infoRate - time.monotonic()
+        if wait > 0:
+            self.roomText.after(int(wait * 1000) + 1, self.flushInfo)
+            return
+        self.infoPending = False
+        self.lastInfo = time.monotonic()
+        self.showInfo()
 
-        self.userText.configure(state='normal')
-        self.userText.delete(1.0,tk.END)
-        for user in self.usernames.values():
-            self.userText.insert(tk.INSERT,user + '\n')
-        self.userText.configure(state='disabled')
+    def showInfo(self):
+        """
+        Add or delete only the rows that changed
+        """
+        widgets = {'rooms': self.roomText, 'users': self.userText}
+        for widget in widgets.values():
+            widget.configure(state='normal')
+
+        while self.infoChanges:
+            panel, added, name = self.infoChanges.popleft()
+            rows = self.infoRows[panel]
+            if added:
+                rows.append(name)
+                widgets[panel].insert(tk.END, name + '\n')
+            elif name in rows:
+                line = rows.index(name) + 1
+                rows.pop(line - 1)
+                widgets[panel].delete(f'{line}.0', f'{line + 1}.0')
+
+        for widget in widgets.values():
+            widget.configure(state='disabled')
 
     def processMessage(self, client,  message):
         """
         message - (OPCODE, LENGTH, PAYLOAD)
-        
+
+        The handler for the opcode is found in self.dispatcher
         """
         opCode, length, payload = message
-        event = self.buildTag(client)
-        error = False
+        result = self.dispatcher.dispatch(opCode, client, payload)
 
-        # Client sent error message
-        if opCode == OPCODES["OPCODE_ERR"]:
-            event += " Client returned error - " + list(ERRORCODES.keys())[payload]
-            error = True
-        # Client just joined add their username
-        elif opCode == OPCODES["OPCODE_HELLO"]:
-            username = self.createUsername(client, payload)
-            event += f" Updated username to \"{username}\" and sent room list"
-            self.sendRoomlist(client)
-        # Client request for current rooms
-        elif opCode == OPCODES["OPCODE_GET_ROOMS"]:
-            # Convert room list to string and send to client
-            self.sendRoomlist(client)
-            event += " Sent client room list"
-        # TODO Client should not be sending this
-        elif opCode == OPCODES["OPCODE_LIST_ROOMS"]:
-            pass
-        # Client requests users in their room
-        elif opCode == OPCODES["OPCODE_LIST_USERS"]:
-            event, error = self.sendUsers(client, payload)
-        # Client requests creation of room
-        elif opCode == OPCODES["OPCODE_CREATE_ROOM"]:
-            event, error = self.createRoom(client, payload)
-            self.sendRoomlist('all')
-        # Assign user to a room
-        elif opCode == OPCODES["OPCODE_JOIN_ROOM"]:
-            event, error = self.assignRoom(client, payload)
-        # Remove client from their current room
-        elif opCode == OPCODES["OPCODE_LEAVE_ROOM"]:
-            event, error = self.leaveRoom(client)
-            self.sendRoomlist(client)
-            event += " sent client room list"
-        # Client sent a message to their chatroom
-        elif opCode == OPCODES["OPCODE_SEND_MSG"]:
-            event, error = self.broadcast(client, payload)
-        # TODO Client should not be sending this
-        elif opCode == OPCODES["OPCODE_BROADCAST_MSG"]:
-            pass
-        else:
-            pass
+        # Nothing to print or a hook dropped the packet
+        if result is None:
+            return
 
+        event, error = result
         self.printEvent(event,error)
         self.updateInfo()
 
+    def registerHandlers(self):
+        """
+        Route each opcode a client can send to its handler,
+        every handler takes (client, payload) and returns (event, error)
+        """
+        handlers = {
+            "OPCODE_ERR": self.clientError,
+            "OPCODE_HELLO": self.hello,
+            "OPCODE_GET_ROOMS": self.getRooms,
+            "OPCODE_LIST_USERS": self.sendUsers,
+            "OPCODE_CREATE_ROOM": self.newRoom,
+            "OPCODE_JOIN_ROOM": self.assignRoom,
+            "OPCODE_LEAVE_ROOM": self.exitRoom,
+            "OPCODE_SEND_MSG": self.broadcast,
+            "OPCODE_STATS": self.sendStats,
+            "OPCODE_FETCH_HISTORY": self.sendHistory,
+            "OPCODE_PING": self.pong,
+            "OPCODE_PONG": self.pongReceived,
+        }
+        for name, handler in handlers.items():
+            self.dispatcher.register(OPCODES[name], handler)
+
+    def ignore(self, client, payload):
+        """
+        Opcodes a client should not send (LIST_ROOMS, BROADCAST_MSG...)
+        """
+        return client.session.tag, False
+
+    def pong(self, client, payload):
+        # Client checks the connection, answer without printing
+        client.send(encodePacket(OPCODES["OPCODE_PONG"], payload))
+
+    def pongReceived(self, client, payload):
+        # Client answered a ping, any packet already counts as alive
+        return None
+
+    def clientError(self, client, errCode):
+        # Client sent error message
+        return client.session.tag + " Client returned error - " + getErrCode(errCode), True
+
+    def hello(self, client, payload):
+        """
+        Client just joined add their username, the client
+        may follow its username with a compression mode
+        """
+        event = client.session.tag
+        wantName, _, mode = payload.partition('\n')
+        if mode in COMPRESSION_MODES:
+            client.compress = mode
+        username = self.createUsername(client, wantName)
+        event += f" Updated username to \"{username}\" and sent room list"
+        if client.compress:
+            event += f" using {client.compress} compression"
+        self.sendRoomlist(client)
+        return event, False
+
+    def getRooms(self, client, payload):
+        # Convert room list to string and send to client
+        self.sendRoomlist(client)
+        return client.session.tag + " Sent client room list", False
+
+    def newRoom(self, client, wantName):
+        event, error = self.createRoom(client, wantName)
+        self.sendRoomlist('all')
+        return event, error
+
+    def exitRoom(self, client, payload):
+        event, error = self.leaveRoom(client)
+        self.sendRoomlist(client)
+        return event + " sent client room list", error
+
+    def sendHistory(self, client, payload):
+        """
+        Client scrolled back, send the page of messages
+        before the message number in the payload
+        """
+        event = client.session.tag
+        room = client.session.room
+        if room is None:
+            packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_NOT_IN_ROOM"]) + f":ERR_NOT_IN_ROOM - no history, you are not in a room")
+            client.send(packet)
+            return event + str(ERRORCODES["ERR_NOT_IN_ROOM"]) + f":ERR_NOT_IN_ROOM - history request failed, client not in a room", True
+        # isdigit also passes digits int() cannot read, such as "²"
+        try:
+            number = int(payload) if payload.isdecimal() else None
+        except ValueError:
+            number = None
+        if number is None:
+            client.send(encodeError(ERRORCODES["ERR_ILLEGAL_MESSAGE"]))
+            return event + f" Bad history request \"{payload[:20]}\"", True
+
+        messages = self.historyMessages(self.history[room].before(number, HISTORY_PAGE))
+        if messages:
+            client.send(encodePackets(messages,client.compress))
+        return event + f" Sent {len(messages)} older messages from \"{room}\"", False
+
+    def historyMessages(self, history):
+        """
+        OPCODE_HISTORY messages for history entries. An entry too long
+        to send, kept before chats were limited, is skipped
+        """
+        messages = []
+        for message in history:
+            payload = historyPayload(*message)
+            if len(payload.encode()) <= MAX_MESSAGE_SIZE:
+                messages.append((OPCODES["OPCODE_HISTORY"], payload))
+        return messages
+
+    def sendStats(self, client, payload):
+        # Client requests the server metrics
+        client.send(encodePacket(OPCODES["OPCODE_STATS"], self.metrics.render(), client.compress))
+        return client.session.tag + " Sent server stats", False
+
     def sendUsers(self, client, room):
         error = False
-        clientIp = client.getpeername()
-        event = self.buildTag(client)
+        event = client.session.tag
 
         # Room does not exist tell user
-        if room not in self.roomList:
+        if room not in self.roomMembers:
             error = True
             packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_ILLEGAL_NAME"]) + f":ERR_ILLEGAL_NAME - room \"{room}\" does not exists, no users to send")
             client.send(packet)
@@ -239,57 +544,71 @@ class Server:
 
         # Send client the user list
         else:
-            # Get all the usernames
-            # TODO This is awful and these data structures need
-            # to be reworked 
-            clientIpList = []
-            for k,v in self.userRoom.items():
-                if v == room:
-                    clientIpList.append(k.getpeername())
-            userList = []
-            for k,v in self.usernames.items():
-                if k in clientIpList:
-                    userList.append(v)
-
-            userStr = ','.join(userList)
-            packet = encodePacket(OPCODES["OPCODE_LIST_USERS"],userStr)
+            userStr = self.roomUsers(room)
+            packet = encodePacket(OPCODES["OPCODE_LIST_USERS"],userStr,client.compress)
             self.send(client, packet)
 
-            event += f"sent \"{self.usernames[clientIp]}\" userlist for \"{room}\""
+            event += f"sent \"{client.session.username}\" userlist for \"{room}\""
 
         return event, error
 
+    def roomUsers(self, room):
+        """
+        Comma separated usernames of the members of a room
+        """
+        userList = []
+        for member in self.roomMembers[room]:
+            username = member.session.username
+            if username is not None:
+                userList.append(username)
+        for username, count in self.remoteMembers.get(room, {}).items():
+            userList += [username] * count
+        return ','.join(userList)
+
     def sendRoomlist(self, client):
         roomStr = ",".join(self.roomList)
-        packet = encodePacket(OPCODES["OPCODE_LIST_ROOMS"],roomStr)
         if client == 'all':
-            self.updateRoomless(packet)
+            self.updateRoomless(roomStr)
         else:
-            client.send(packet)
+            client.send(encodePacket(OPCODES["OPCODE_LIST_ROOMS"],roomStr,client.compress))
 
 
     def createUsername(self, client, wantName):
         """
-        Adds the username in the username dictionary using their
-        (IP,PORT) as the key.
-
-        If the username exsists finds the first valid "(i)"
-        appended username instead and sends the user an error
-        with their updated name
-        """
-        clientIp = client.getpeername()
-        username = wantName
-        i = 1
-        if username in self.usernames.values():
-            tempName = username + f"({i})"
-            while tempName in self.usernames.values():
-                i += 1
-                tempName = username + f"({i})"
-            username = tempName
+        Sets the username in the client's session.
+
+        If the username exsists the name index hands out a free "(i)"
+        appended username instead and the user is sent an error
+        with their updated name.
+
+        A client renamed while in a room leaves it under the old
+        name and joins again under the new one
+        """
+        session = client.session
+        oldName = session.username
+        # "@" marks the names of users on other workers
+        if self.nodeName:
+            wantName = wantName.replace('@', '_')
+        # A second hello frees the name taken by the first
+        if oldName is not None:
+            self.nameIndex.release(oldName)
+        username = self.nameIndex.claim(wantName)
+        if username != wantName:
             packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_NAME_EXISTS"]) + f":ERR_NAME_EXISTS - your username is now \"{username}\"")
             client.send(packet)
 
-        self.usernames[clientIp] = username
+        if username == oldName:
+            return username
+
+        room = session.room
+        if room is not None:
+            self.dropMember(client)
+        if oldName is not None:
+            self.infoChanges.append(('users', False, oldName))
+        session.rename(username)
+        self.infoChanges.append(('users', True, username))
+        if room is not None:
+            self.joinMember(client, room)
         return username
 
     def createRoom(self, client, wantName):
@@ -301,27 +620,47 @@ class Server:
         a message they have joined the room.
         """
         error = False
-        event = self.buildTag(client)
+        event = client.session.tag
 
         # Room already exists produce client and server error
-        if wantName in self.roomList:
+        if wantName in self.roomMembers:
             error = True
             packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_NAME_EXISTS"]) + f":ERR_NAME_EXISTS - room \"{wantName}\" already exists")
             client.send(packet)
             event += f"ERR_NAME_EXISTS - room name \"{wantName}\" alread exsists"
 
+        # Room name too long to list or keep
+        elif len(wantName.encode()) > MAX_ROOM_NAME:
+            error = True
+            packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_ILLEGAL_NAME"]) + f":ERR_ILLEGAL_NAME - room names are at most {MAX_ROOM_NAME} bytes")
+            client.send(packet)
+            event += str(ERRORCODES["ERR_ILLEGAL_NAME"]) + f":ERR_ILLEGAL_NAME - client room name longer than {MAX_ROOM_NAME} bytes"
+
         # Create room, if user is in another room remove them,
         # add user to room
         else:
-            self.roomList.append(wantName)
-            if client in self.userRoom:
-                packet = encodePacket(OPCODES["OPCODE_LEAVE_ROOM"],self.userRoom[client])
+            # The history is opened first, a room without one is never listed
+            try:
+                history = RoomHistory(wantName, self.historyDir)
+            except OSError as err:
+                packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_UNKNOWN"]) + f":ERR_UNKNOWN - room \"{wantName}\" could not be created")
                 client.send(packet)
-                self.userRoom.pop(client)
-            self.userRoom[client] = wantName
+                return event + str(ERRORCODES["ERR_UNKNOWN"]) + f":ERR_UNKNOWN - room history could not be opened - {err}", True
+            self.roomList.append(wantName)
+            self.infoChanges.append(('rooms', True, wantName))
+            self.roomMembers[wantName] = {}
+            self.remoteMembers[wantName] = {}
+            self.history[wantName] = history
+            self.publish(OPCODES["OPCODE_PEER_ROOM"], wantName)
+            messages = []
+            if client.session.room is not None:
+                messages.append((OPCODES["OPCODE_LEAVE_ROOM"],client.session.room))
+                self.dropMember(client)
+            self.joinMember(client, wantName)
             event += f" Room \"{wantName}\" created"
-            packet = encodePacket(OPCODES["OPCODE_JOIN_ROOM"],wantName)
-            client.send(packet)
+            messages.append((OPCODES["OPCODE_JOIN_ROOM"],wantName))
+            messages.append((OPCODES["OPCODE_LIST_USERS"],self.roomUsers(wantName)))
+            client.send(encodePackets(messages,client.compress))
 
         return event, error
 
@@ -335,18 +674,28 @@ class Server:
         room that does not exsist
         """
         error = False
-        event = self.buildTag(client)
+        event = client.session.tag
 
         # Room exists remove user from current room if any
         # then add them to the room
-        if room in self.roomList:
-            if client in self.userRoom:
-                packet = encodePacket(OPCODES["OPCODE_LEAVE_ROOM"],self.userRoom[client])
-                client.send(packet)
-                self.userRoom.pop(client)
-            packet = encodePacket(OPCODES["OPCODE_JOIN_ROOM"],room)
-            client.send(packet)
-            self.userRoom[client] = room
+        if room in self.roomMembers:
+            messages = []
+            if client.session.room is not None:
+                messages.append((OPCODES["OPCODE_LEAVE_ROOM"],client.session.room))
+                self.dropMember(client)
+            messages.append((OPCODES["OPCODE_JOIN_ROOM"],room))
+            self.joinMember(client, room)
+
+            # The joining client gets the full user list once,
+            # the other members only hear about the new user.
+            # The room's latest messages follow in the same write
+            messages.append((OPCODES["OPCODE_LIST_USERS"],self.roomUsers(room)))
+            history = self.historyMessages(self.history[room].recent(self.historyReplay))
+            try:
+                client.send(encodePackets(messages + history,client.compress))
+            # The join still succeeds without the replay
+            except ValueError:
+                client.send(encodePackets(messages,client.compress))
             event += f" joined chatroom \"{room}\""
 
         # Room does not exists send error to user
@@ -365,14 +714,15 @@ class Server:
         If they are not in a room send them an error
         """
         error = False
-        event = self.buildTag(client)
+        event = client.session.tag
 
         # Remove client from their current room
-        if client in self.userRoom:
-            packet = encodePacket(OPCODES["OPCODE_LEAVE_ROOM"],self.userRoom[client])
+        room = client.session.room
+        if room is not None:
+            packet = encodePacket(OPCODES["OPCODE_LEAVE_ROOM"],room)
             client.send(packet)
-            event += f" left chatroom \"{self.userRoom[client]}\""
-            self.userRoom.pop(client)
+            event += f" left chatroom \"{room}\""
+            self.dropMember(client)
 
         # Client is not in a room
         else:
@@ -390,34 +740,33 @@ class Server:
         If the client is not in a room produce an error
         Otherwise send the message to all clients in the room
         
-        Copy the current client list to iterate.
+        Copy the room's member list to iterate.
 
         Try and send them the packet if their connection
         is no longer active remove them from original list 
         and close the connection.
         """
         error = False
-        event = self.buildTag(client)
+        event = client.session.tag
 
         # Send message to only clients in the same room
-        if client in self.userRoom:
+        session = client.session
+        room = session.room
+        if room is not None:
 
             # get username and attach it to append payload to it
-            clientIp = client.getpeername()
-            username = self.usernames[clientIp]
-            newPayload = "<" + username +"> " + payload
-            packet = encodePacket(OPCODES["OPCODE_BROADCAST_MSG"],newPayload)
-
-            room = self.userRoom[client]
-            currClients = self.clientList.copy()
-            for otherClient in currClients:
-                if otherClient in self.userRoom.keys():
-                    if self.userRoom[otherClient] == room:
-                        try:
-                            otherClient.send(packet)
-                        except:
-                            self.remove(otherClient)
-                            otherClient.close()
+            newPayload = "<" + session.username +"> " + payload
+
+            # Too long once named, every copy would fail to encode
+            if len(newPayload.encode()) + len(room.encode()) > MAX_CHAT_SIZE:
+                # A bare length error would have the client resend it
+                packet = encodePacket(OPCODES["OPCODE_ERR"],str(ERRORCODES["ERR_ILLEGAL_LENGTH"]) + f":ERR_ILLEGAL_LENGTH - message too long to send in \"{room}\"")
+                client.send(packet)
+                return event + str(ERRORCODES["ERR_ILLEGAL_LENGTH"]) + f":ERR_ILLEGAL_LENGTH - client message too long to send in \"{room}\"", True
+
+            self.fanOut(self.roomMembers[room], OPCODES["OPCODE_BROADCAST_MSG"], newPayload)
+            self.history[room].append(newPayload)
+            self.publish(OPCODES["OPCODE_PEER_BROADCAST"], room, "<" + self.remoteName(session.username) + "> " + payload)
             event += f" sent a message in \"{room}\""
 
         # Client is not in a room cannot send
@@ -429,38 +778,354 @@ class Server:
 
         return event, error
 
-    def updateRoomless(self, packet):
+    def joinMember(self, client, room):
+        """
+        Record the client as a member of the room
+        and tell the other members they joined
+        """
+        self.notifyMembers(client, room, OPCODES["OPCODE_USER_JOINED"])
+        client.session.room = room
+        self.roomMembers[room][client] = None
+        self.publishMember(OPCODES["OPCODE_PEER_JOIN"], client, room)
+
+    def dropMember(self, client):
+        """
+        Remove the client from the room they are in, if any,
+        and tell the remaining members they left
+        """
+        session = client.session
+        room = session.room
+        if room is not None:
+            session.room = None
+            self.roomMembers[room].pop(client, None)
+            self.notifyMembers(client, room, OPCODES["OPCODE_USER_LEFT"])
+            self.publishMember(OPCODES["OPCODE_PEER_LEAVE"], client, room)
+
+    def notifyMembers(self, client, room, opCode):
+        """
+        Send the client's username to the members of a room
+        """
+        username = client.session.username
+        if username is None:
+            return
+        members = [member for member in self.roomMembers[room] if member is not client]
+        self.fanOut(members, opCode, username)
+
+    def updateRoomless(self, roomStr):
         """
         Send the roomlist to all users that are not currently in a room.
-        
-        Copy the current client list to iterate.
+        """
+        roomless = [client for client in self.clientList if client.session.room is None]
+        self.fanOut(roomless, OPCODES["OPCODE_LIST_ROOMS"], roomStr)
 
-        Try and send them the packet if their connection
-        is no longer active remove them from original list 
-        and close the connection.
+    def publish(self, opCode, *fields):
+        """
+        Tell the other workers of a cluster about a change,
+        the fields are sent separated by new lines
         """
+        if self.bus:
+            self.bus.publish(opCode, '\n'.join(fields))
 
-        currClients = self.clientList.copy()
-        for client in currClients:
-            if client not in self.userRoom:
-                try:
-                    client.send(packet)
-                except:
-                    self.remove(client)
-                    client.close()
+    def publishMember(self, opCode, client, room):
+        username = client.session.username
+        if self.bus and username is not None:
+            self.publish(opCode, room, self.remoteName(username))
+
+    def remoteName(self, username):
+        """
+        The username as other workers show it
+        """
+        if self.nodeName:
+            return f'{username}@{self.nodeName}'
+        return username
+
+    def busReceived(self, opCode, payload):
+        """
+        Called by the bus reader thread for every packet
+        from another worker
+        """
+        self.peerDispatcher.dispatch(opCode, payload)
+
+    def registerPeerHandlers(self):
+        handlers = {
+            "OPCODE_PEER_ROOM": self.peerRoom,
+            "OPCODE_PEER_JOIN": self.peerJoin,
+            "OPCODE_PEER_LEAVE": self.peerLeave,
+            "OPCODE_PEER_BROADCAST": self.peerBroadcast,
+        }
+        for name, handler in handlers.items():
+            self.peerDispatcher.register(OPCODES[name], handler)
+
+    def peerRoom(self, room):
+        """
+        A room was created on another worker
+        """
+        if room in self.roomMembers or len(room.encode()) > MAX_ROOM_NAME:
+            return
+        try:
+            history = RoomHistory(room, self.historyDir)
+        except OSError as err:
+            self.printEvent(f"Room \"{room}\" from another worker not added - {err}", True)
+            return
+        self.roomList.append(room)
+        self.roomMembers[room] = {}
+        self.remoteMembers[room] = {}
+        self.history[room] = history
+        self.infoChanges.append(('rooms', True, room))
+        self.sendRoomlist('all')
+        self.updateInfo()
+
+    def peerJoin(self, payload):
+        """
+        A user on another worker joined a room, tell its members here
+        """
+        room, username = payload.split('\n', 1)
+        self.peerRoom(room)
+        if room not in self.remoteMembers:
+            return
+        members = self.remoteMembers[room]
+        members[username] = members.get(username, 0) + 1
+        self.fanOut(self.roomMembers[room], OPCODES["OPCODE_USER_JOINED"], username)
+
+    def peerLeave(self, payload):
+        room, username = payload.split('\n', 1)
+        members = self.remoteMembers.get(room, {})
+        if username not in members:
+            return
+        members[username] -= 1
+        if not members[username]:
+            del members[username]
+        self.fanOut(self.roomMembers[room], OPCODES["OPCODE_USER_LEFT"], username)
+
+    def peerBroadcast(self, payload):
+        """
+        A message sent in a room on another worker,
+        pass it on to the members here
+        """
+        room, message = payload.split('\n', 1)
+        if room in self.roomMembers:
+            self.fanOut(self.roomMembers[room], OPCODES["OPCODE_BROADCAST_MSG"], message)
+            self.history[room].append(message)
+
+    def fanOut(self, clients, opCode, payload):
+        """
+        Send one message to many clients.
+
+        The packet is encoded once for each compression mode in use
+        so the payload is never compressed more than once.
+
+        Copy the client list to iterate. Try and send them the packet
+        if their connection is no longer active remove them from
+        original list and close the connection.
+        """
+        packets = {}
+        clients = list(clients)
+        self.metrics.fannedOut(opCode, len(clients))
+        for client in clients:
+            mode = client.compress
+            if mode not in packets:
+                packets[mode] = encodePacket(opCode, payload, mode)
+            try:
+                client.send(packets[mode])
+            except:
+                self.closeClient(client)
 
     def send(self, client, packet):
         """
         Store the last packet for each client to resend on 
         certain errors
         """
-        self.lastPacket[client] = packet
+        client.session.lastPacket = packet
         client.send(packet)
 
     def resend(self, client):
         """
         Resend most recent packet
         """
-        event = self.buildTag(client) + "Resending last packet"
+        event = client.session.tag + "Resending last packet"
         self.printEvent(event,True)
-        client.send(self.lastPacket[client])
+        client.send(client.session.lastPacket)
+
+
+
+class TransportSocket:
+    """
+    Wraps an asyncio transport so it can be used by the Server
+    exactly like a client socket (send, getpeername, close)
+
+    Packets wait in a bounded outbox and everything sent to the client
+    during one pass of the event loop is written together. While the
+    transport's buffer is full the outbox is not drained, so a slow
+    reader cannot grow the server's memory
+    """
+    __slots__ = ('transport', 'loop', 'peername', 'outbox', 'paused', 'flushing', 'writes', 'compress', 'metrics', 'session')
+
+    def __init__(self, transport, outbox, loop, metrics=None):
+        self.transport = transport
+        self.outbox = outbox
+        self.loop = loop
+        # Counts the packets queued, optional
+        self.metrics = metrics
+        # Compression mode chosen in the HELLO handshake
+        self.compress = None
+        self.paused = False
+        self.flushing = False
+        # Number of writes made to the transport
+        self.writes = 0
+        # Cache the address, the transport already knows it
+        self.peername = transport.get_extra_info('peername')[:2]
+        # The client's Session, set by the server
+        self.session = None
+
+    def send(self, data):
+        # Client is too slow, drop it without waiting for its buffer
+        if not self.outbox.put(data, block=False):
+            self.outbox.close()
+            self.transport.abort()
+            return len(data)
+        if self.metrics:
+            self.metrics.sent(data)
+        if not self.paused:
+            # Write a large burst now rather than let it reach the limit
+            outbox = self.outbox
+            if len(outbox) >= outbox.maxSize // 2 or outbox.bytes >= outbox.maxBytes // 2:
+                self.flush()
+            elif not self.flushing:
+                self.flushing = True
+                self.loop.call_soon(self.flush)
+        return len(data)
+
+    def flush(self):
+        """
+        Write everything queued for the client in one call
+        """
+        self.flushing = False
+        if self.paused:
+            return
+        frames = self.outbox.take(block=False)
+        if frames:
+            self.writes += 1
+            self.transport.writelines(frames)
+
+    def pauseWriting(self):
+        self.paused = True
+
+    def resumeWriting(self):
+        """
+        The client caught up, write everything that was held back
+        """
+        self.paused = False
+        self.flush()
+
+    def getpeername(self):
+        return self.peername
+
+    def close(self):
+        """
+        Only dead or dropped clients are closed, anything still
+        queued is discarded rather than waiting on the peer
+        """
+        self.outbox.close()
+        self.transport.abort()
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    One protocol instance per connection on the asyncio engine.
+    Hands every packet recieved to Server.handlePacket
+    """
+    __slots__ = ('server', 'client', 'decoder')
+
+    def __init__(self, server):
+        self.server = server
+        self.client = None
+        self.decoder = FrameDecoder()
+
+    def connection_made(self, transport):
+        server = self.server
+        self.client = TransportSocket(transport, Outbox(server.outboxSize, server.outboxPolicy, server.outboxBytes), server.loop, server.metrics)
+        self.client.session = Session(self.client.peername)
+        server.lifecycle.watch(self.client)
+        server.metrics.connected()
+
+        # Add client to the client list
+        self.server.clientList.append(self.client)
+
+        # prints the address of the user that just connected
+        event = self.client.session.tag + " connected"
+        self.server.printEvent(event)
+
+        # Connection establised send the client the hellow message
+        self.client.send(self.server.helloPacket())
+
+    def data_received(self, data):
+        self.client.session.lastSeen = time.monotonic()
+        self.server.metrics.read(len(data))
+        for decodedPkt in self.decoder.feed(data):
+            self.server.handlePacket(self.client, decodedPkt)
+        if self.decoder.failed:
+            self.server.closeClient(self.client)
+
+    def pause_writing(self):
+        self.client.pauseWriting()
+
+    def resume_writing(self):
+        self.client.resumeWriting()
+
+    def connection_lost(self, exc):
+        self.server.closeClient(self.client)
+
+
+class AsyncServer(Server):
+    """
+    Server engine that serves every client from a single asyncio
+    event loop instead of starting a thread per client.
+
+    Packets are processed by the same Server methods so opcode
+    behavior is identical to the threaded engine.
+    """
+
+    def runServer(self):
+        """
+        This should be run in its own thread.
+
+        Runs the event loop until the server is stopped
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+            self.server.close()
+
+    def busReceived(self, opCode, payload):
+        """
+        Packets from other workers are handled on the event loop
+        like everything else
+        """
+        self.loop.call_soon_threadsafe(self.peerDispatcher.dispatch, opCode, payload)
+
+    def expireClients(self):
+        """
+        Ping and reap silent clients on the event loop
+        """
+        self.loop.call_later(self.lifecycle.expire(), self.expireClients)
+
+    async def serve(self):
+        event = "Server running on " + self.netInfo[0] + ":" + str(self.netInfo[1]) + " (asyncio)"
+        self.printEvent(event)
+        self.updateInfo()
+        if self.bus:
+            self.bus.start(self.busReceived)
+        if self.snapshots:
+            self.snapshots.start()
+        if self.lifecycle.enabled:
+            self.loop.call_soon(self.expireClients)
+
+        self.server.setblocking(False)
+        listener = await self.loop.create_server(lambda: ClientProtocol(self),
+                                                 sock=self.server, backlog=ASYNC_BACKLOG)
+        async with listener:
+            while self.running:
+                await asyncio.sleep(0.5)
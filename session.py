@@ -0,0 +1,43 @@
+class Session:
+    """
+    What the server knows about one connection, created when the
+    connection is accepted and kept on it as client.session.
+
+    The address is read once and the tag printed with every event
+    is rebuilt only when the username changes
+    """
+    __slots__ = ('peer', 'username', 'room', 'tag', 'lastPacket', 'lastSeen', 'lastPing', 'closed')
+
+    def __init__(self, peer):
+        self.peer = peer
+        self.username = None
+        # Room the client is in, None when in no room
+        self.room = None
+        # Last packet sent, resent on certain errors
+        self.lastPacket = None
+        # When a packet last arrived and the last ping was sent,
+        # time.monotonic()
+        self.lastSeen = 0
+        self.lastPing = 0
+        # Set once the server has closed the connection
+        self.closed = False
+        self.tag = self.buildTag()
+
+    def rename(self, username):
+        """
+        Set the username, None once the name is given up
+        """
+        self.username = username
+        self.tag = self.buildTag()
+
+    def buildTag(self):
+        """
+        Tag for printing events. Always contains IP:PORT
+        appends Username if present.
+
+        <ClientIP:PORT - Username>
+        """
+        tag = "<" + self.peer[0] + ":" + str(self.peer[1])
+        if self.username is not None:
+            return tag + " - " + self.username + ">"
+        return tag + ">"
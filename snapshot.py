@@ -0,0 +1,137 @@
+import os, struct, threading, zlib
+from _thread import *
+
+"""
+Snapshot file layout, all integers little endian
+
+    MAGIC  VERSION(H)  ROOMS(I)
+    ROOMS x [ NAME LENGTH(H)  NAME  HISTORY CURSOR(Q) ]
+    CRC32(I) of everything before it
+"""
+SNAPSHOT_MAGIC = b'CHATSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<8sHI')
+NAME_STRUCT = struct.Struct('<H')
+CURSOR_STRUCT = struct.Struct('<Q')
+CRC_STRUCT = struct.Struct('<I')
+
+"""
+Seconds between snapshots, nothing is written while nothing changed
+"""
+SNAPSHOT_INTERVAL = 30
+
+def packSnapshot(rooms):
+    """
+    rooms - [(NAME, HISTORY CURSOR), ...] in the order they were created
+    """
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(rooms))]
+    for name, cursor in rooms:
+        data = name.encode()
+        parts.append(NAME_STRUCT.pack(len(data)))
+        parts.append(data)
+        parts.append(CURSOR_STRUCT.pack(cursor))
+    body = b''.join(parts)
+    return body + CRC_STRUCT.pack(zlib.crc32(body))
+
+def unpackSnapshot(data):
+    """
+    Returns [(NAME, HISTORY CURSOR), ...] or None if the
+    data is not a valid snapshot
+    """
+    if len(data) < SNAPSHOT_HEADER.size + CRC_STRUCT.size:
+        return None
+    body = memoryview(data)[:-CRC_STRUCT.size]
+    if CRC_STRUCT.unpack_from(data, len(body))[0] != zlib.crc32(body):
+        return None
+    magic, version, count = SNAPSHOT_HEADER.unpack_from(body)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+
+    rooms = []
+    offset = SNAPSHOT_HEADER.size
+    try:
+        for i in range(count):
+            length, = NAME_STRUCT.unpack_from(body, offset)
+            offset += NAME_STRUCT.size
+            name = str(body[offset:offset + length], 'utf-8')
+            offset += length
+            cursor, = CURSOR_STRUCT.unpack_from(body, offset)
+            offset += CURSOR_STRUCT.size
+            rooms.append((name, cursor))
+    except (struct.error, UnicodeDecodeError):
+        return None
+    return rooms
+
+def loadSnapshot(path):
+    """
+    Read a snapshot file, None if there is none or it is damaged
+    """
+    try:
+        with open(path, 'rb') as f:
+            return unpackSnapshot(f.read())
+    except OSError:
+        return None
+
+def saveSnapshot(path, rooms):
+    """
+    Replace the snapshot at path. The new file is written and synced
+    beside the old one then renamed over it, so a crash leaves
+    either the old snapshot or the new one, never half of one
+    """
+    data = packSnapshot(rooms)
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+
+class SnapshotWriter:
+    """
+    Saves snapshots on a background thread.
+
+    collect is called on the writer thread and must return the rooms
+    quickly from copies, packing and writing never happen on the
+    thread serving clients. A snapshot that cannot be written is
+    passed to failed(ERROR) and the writer carries on
+    """
+
+    def __init__(self, path, collect, interval=SNAPSHOT_INTERVAL, failed=None):
+        self.path = path
+        self.collect = collect
+        self.interval = interval
+        self.failed = failed
+        self.lock = threading.Lock()
+        self.last = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        start_new_thread(self.run, ())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.save()
+
+    def save(self):
+        """
+        Write a snapshot if anything changed since the last one
+        """
+        rooms = self.collect()
+        with self.lock:
+            if rooms == self.last:
+                return
+            try:
+                saveSnapshot(self.path, rooms)
+            except (OSError, struct.error) as error:
+                if self.failed:
+                    self.failed(error)
+                return
+            self.last = rooms
+
+    def stop(self):
+        """
+        Stop the writer and save one last snapshot
+        """
+        self.stopped.set()
+        self.save()